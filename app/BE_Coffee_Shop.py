@@ -1,16 +1,57 @@
+from abc import ABC, abstractmethod
+import asyncio
 from enum import Enum
 from datetime import datetime, timedelta
 import csv
-import pika.connection
-from scipy import stats
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import math
 import numpy as np
-import random
 import time
-import pika
 import json
+import pickle
 import os
 import logging
-from dependency_injector import containers, providers
+import logging.handlers
+import atexit
+import queue
+from event_log import EventSink
+from instrumentation import Instruments, TimedLogger
+from metrics import ShopMetrics
+from trace_writer import TraceWriter
+
+
+def norm_cdf(x, loc, scale):
+    return 0.5 * (1 + math.erf((x - loc) / (scale * math.sqrt(2))))
+
+
+def _truncated_normal_ppf(mu, std, u):
+    """
+    Element-wise quantile `u` of N(mu, std) truncated at zero, for whole arrays
+    of draws. One uniform per draw and no rejection, so Drink.prep_minutes
+    gives the same time for the same uniform. scipy is only imported here.
+    """
+    from scipy import special
+
+    std = np.asarray(std, dtype=float)
+    safe_std = np.where(std > 0, std, 1.0)
+    below = special.ndtr(-np.asarray(mu) / safe_std)
+    q = np.minimum(below + u * (1 - below), np.nextafter(1.0, 0.0))
+    minutes = np.maximum(mu + safe_std * special.ndtri(q), 0.0)
+    return np.where(std > 0, minutes, np.maximum(mu, 0.0))
+
+
+@functools.cache
+def _normal_inv_cdf():
+    """
+    Standard normal quantile function for single draws, which costs about a
+    microsecond where scipy's ufuncs on a scalar cost tens
+    """
+    from statistics import NormalDist
+
+    return NormalDist().inv_cdf
 
 
 class Drink:
@@ -19,6 +60,19 @@ class Drink:
         self.std = std
         self.name = name
 
+    def prep_minutes(self, u: float) -> float:
+        """
+        Preparation time in minutes at quantile `u` of N(mu, std) truncated at
+        zero, the scalar form of _truncated_normal_ppf
+        """
+        if self.std <= 0:
+            return max(self.mu, 0.0)
+        below = 0.5 * math.erfc(self.mu / (self.std * math.sqrt(2)))
+        q = min(below + u * (1 - below), math.nextafter(1.0, 0.0))
+        if q <= 0:
+            return 0.0
+        return max(self.mu + self.std * _normal_inv_cdf()(q), 0.0)
+
 
 class Skill(Enum):
     Amature = 1
@@ -26,36 +80,178 @@ class Skill(Enum):
     expert = 3
 
 
+class Menu:
+    """
+    A parsed menu CSV. `mu` and `std` are (len(Skill), drinks) arrays already
+    scaled per skill level (row `level.value - 1`) and `drinks` holds the
+    matching read-only Drink objects, shared by every barista of that level.
+    """
+
+    SKILL_SCALE = {Skill.Amature: 0.2, Skill.midlevel: 0.0, Skill.expert: -0.2}
+
+    def __init__(self, csv_file, mtime=None):
+        self.path = csv_file
+        self.mtime = mtime
+        names, means, stds = [], [], []
+        with open(csv_file, "r") as file:
+            reader = csv.reader(file)
+            next(reader)
+            for row in reader:
+                names.append(row[0].strip().lower())
+                means.append(float(row[1]))
+                stds.append(float(row[2]))
+        self.drink_list = tuple(names)
+        self.index = {name: i for i, name in enumerate(names)}
+        scale = np.array([[self.SKILL_SCALE[level]] for level in Skill])
+        means = np.array(means)
+        stds = np.array(stds)
+        self.mu = means + scale * means
+        self.std = stds + scale * stds
+        self.mu.flags.writeable = False
+        self.std.flags.writeable = False
+        self.drinks = {
+            level: tuple(
+                Drink(name, mean, std)
+                for name, mean, std in zip(
+                    names,
+                    self.mu[level.value - 1].tolist(),
+                    self.std[level.value - 1].tolist(),
+                )
+            )
+            for level in Skill
+        }
+
+
+class MenuRegistry:
+    """
+    Parses every menu CSV once and hands out the same Menu until the file's
+    modification time changes
+    """
+
+    def __init__(self) -> None:
+        self.menus = {}
+
+    def get(self, csv_file) -> Menu:
+        path = os.path.abspath(csv_file)
+        mtime = os.stat(path).st_mtime_ns
+        menu = self.menus.get(path)
+        if menu is None or menu.mtime != mtime:
+            menu = Menu(path, mtime)
+            self.menus[path] = menu
+        return menu
+
+
+menu_registry = MenuRegistry()
+
+
 class Barista:
     def __init__(self, csv_file, level):
         """
         The order of the lines in __init__ matters
         """
         self.level = level
-        self.drink_list = []
-        self._read_csv(csv_file)
+        self.menu = menu_registry.get(csv_file)
+        self.drinks = self.menu.drinks[level]
+        self.drink_list = self.menu.drink_list
         self.customer = None
+        self.hire_order = None
 
-    def _read_csv(self, csv_file):
-        with open(csv_file, "r") as file:
-            reader = csv.reader(file)
-            next(reader)
-            for row in reader:
-                drink_name = row[0].strip().lower()
-                match self.level:
-                    case Skill.Amature:
-                        mean = float(row[1]) + 0.2 * float(row[1])
-                        std = float(row[2]) + 0.2 * float(row[2])
-                    case Skill.midlevel:
-                        mean = float(row[1])
-                        std = float(row[2])
-                    case Skill.expert:
-                        mean = float(row[1]) - 0.2 * float(row[1])
-                        std = float(row[2]) - 0.2 * float(row[2])
-                drink = Drink(drink_name, mean, std)
-                setattr(self, drink_name, drink)
-                self.__dict__[drink_name] = drink
-                self.drink_list.append(drink_name)
+    def __getattr__(self, name):
+        menu = self.__dict__.get("menu")
+        if menu is None or name not in menu.index:
+            raise AttributeError(name)
+        return self.drinks[menu.index[name]]
+
+    def choose_drink(self, u: float) -> Drink:
+        """
+        The drink at uniform draw `u` in [0, 1), every drink equally likely
+        """
+        return self.drinks[int(u * len(self.drinks))]
+
+
+def spawn_seed(seed, i: int) -> np.random.SeedSequence:
+    """
+    The i-th child SeedSequence.spawn hands out for `seed`, without advancing
+    it, so child i is the same whoever asks for it first
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return np.random.SeedSequence(
+        seed.entropy, spawn_key=seed.spawn_key + (i,), pool_size=seed.pool_size
+    )
+
+
+class UniformStream:
+    """
+    Uniform [0, 1) draws of one PCG64 stream, generated `batch_size` at a
+    time. `at(k)` is the k-th value of the stream, so draws indexed by an
+    entity (a customer's position in row) do not depend on the order entities
+    ask for them, and `take(k)` returns the first k values in one array.
+    `next()` reads the stream sequentially instead; a stream is read one way
+    or the other.
+    """
+
+    def __init__(self, seed: np.random.SeedSequence, batch_size=1024):
+        self.seed = seed
+        self.batch_size = batch_size
+        self.block = -1
+        self.values = []
+        self.generator = np.random.Generator(np.random.PCG64(seed))
+        self.batch = []
+        self.position = 0
+
+    def at(self, k: int) -> float:
+        block, offset = divmod(k, self.batch_size)
+        if block != self.block:
+            bit_generator = np.random.PCG64(self.seed)
+            bit_generator.advance(block * self.batch_size)
+            self.values = (
+                np.random.Generator(bit_generator).random(self.batch_size).tolist()
+            )
+            self.block = block
+        return self.values[offset]
+
+    def take(self, k: int) -> np.ndarray:
+        return np.random.Generator(np.random.PCG64(self.seed)).random(k)
+
+    def next(self) -> float:
+        if self.position == len(self.batch):
+            self.batch = self.generator.random(self.batch_size).tolist()
+            self.position = 0
+        self.position += 1
+        return self.batch[self.position - 1]
+
+
+class RandomStreams:
+    """
+    Every random number of one simulation. `seed` (an int, a SeedSequence or
+    None for fresh entropy) is spawned into independent streams: `arrivals`,
+    `drinks` for the drink each customer picks and `prep_time` for how long
+    it takes. Customers draw at their position in row, which is what lets
+    `replicate` reproduce a serial run from the same seed.
+    """
+
+    def __init__(self, seed=None, batch_size=1024) -> None:
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed
+        self.arrivals, self.drinks, self.prep_time = (
+            UniformStream(spawn_seed(seed, i), batch_size) for i in range(3)
+        )
+
+    def poisson_arrivals(self, per_minute: float, minutes: float) -> np.ndarray:
+        """
+        Arrival times in minutes of a Poisson process over [0, minutes)
+        """
+        expected = int(per_minute * minutes + 10 * np.sqrt(per_minute * minutes + 1)) + 16
+        gaps = -np.log1p(-self.arrivals.take(expected)) / per_minute
+        times = np.cumsum(gaps)
+        return times[times < minutes]
+
+
+class PrepTime(Enum):
+    per_tick = 1
+    sampled = 2
 
 
 class Status(Enum):
@@ -82,11 +278,37 @@ class Character(Enum):
         "Laid-back and easygoing, with a polite and friendly demeanor. Not in a hurry, so rarely shows any signs of frustration.",
     )
 
+    @classmethod
+    def from_index(cls, index: int):
+        """
+        Messages refer to characters by their 1-based position in this enum
+        """
+        characters = list(cls)
+        if not 1 <= index <= len(characters):
+            raise ValueError(f"character_index must be between 1 and {len(characters)}")
+        return characters[index - 1]
+
 
 class Customer:
+    __slots__ = (
+        "id",
+        "position_in_row",
+        "arrival_time",
+        "status",
+        "character",
+        "order_start_time",
+        "order_time",
+        "next",
+        "prev",
+        "order",
+        "ready_time",
+        "barista",
+    )
+
     def __init__(
         self, position_in_row: int, character: Character, arrival_time: datetime
     ) -> None:
+        self.id: int = None
         self.position_in_row = position_in_row
         self.arrival_time: datetime = arrival_time
         self.status = Status.in_row
@@ -94,22 +316,118 @@ class Customer:
         self.order_start_time: datetime = None
         self.order_time: datetime = None
         self.next = None
+        self.prev = None
         self.order: Drink = None
+        self.ready_time: datetime = None
+        self.barista = None
+
+    def __getstate__(self):
+        """
+        The line links are left out (Waitingline restores them), so pickling
+        a long line does not recurse customer by customer
+        """
+        return {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if name not in ("next", "prev")
+        }
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        for name in ("next", "prev"):
+            if not hasattr(self, name):
+                setattr(self, name, None)
 
-    def is_drink_ready(self, current_time: datetime):
+    def is_drink_ready(self, current_time: datetime, u: float) -> bool:
         time_waited = current_time - self.order_time
-        p = stats.norm.cdf(
+        p = norm_cdf(
             int(time_waited.total_seconds() / 60),
             loc=self.order.mu,
             scale=self.order.std,
         )
-        k = np.random.choice([0, 1], p=[1 - p, p])
-        return k
+        return u < p
+
+    def drink_ready_time(self, stream: UniformStream) -> datetime:
+        """
+        Replays the minute by minute readiness check from the order time and
+        returns the first minute the drink is ready, so the event engine can
+        schedule it without ticking
+        """
+        minutes = 0
+        while not self.is_drink_ready(
+            self.order_time + timedelta(minutes=minutes), stream.next()
+        ):
+            minutes += 1
+        return self.order_time + timedelta(minutes=minutes)
+
+    def sample_ready_time(self, u: float) -> datetime:
+        """
+        The ready time at quantile `u` of the prep time distribution of the order
+        """
+        return self.order_time + timedelta(minutes=self.order.prep_minutes(u))
+
+
+class CustomerStore:
+    """
+    Slab of the customers currently in the shop, indexed by the integer id it
+    hands out on insert. Ids of removed customers are reused and the slab
+    doubles when full, so insert, lookup and removal are O(1).
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self.slots = [None] * capacity
+        self.free = []
+        self.next_id = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, index: int) -> bool:
+        return 0 <= index < self.next_id and self.slots[index] is not None
+
+    def __getitem__(self, index: int) -> Customer:
+        if index not in self:
+            raise KeyError(index)
+        return self.slots[index]
+
+    def __iter__(self):
+        for customer in self.slots[: self.next_id]:
+            if customer is not None:
+                yield customer
+
+    def insert(self, customer: Customer) -> int:
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = self.next_id
+            self.next_id += 1
+            if index == len(self.slots):
+                self.slots.extend([None] * len(self.slots))
+        self.slots[index] = customer
+        customer.id = index
+        self.count += 1
+        return index
+
+    def remove(self, index: int) -> Customer:
+        customer = self[index]
+        self.slots[index] = None
+        self.free.append(index)
+        self.count -= 1
+        return customer
 
 
 class Waitingline:
+    """
+    Doubly linked line. `last` is the newest customer and every `next` points
+    one step closer to the counter, where `first` is waiting.
+    """
+
     def __init__(self) -> None:
         self.last = None
+        self.first = None
+        self.length = 0
 
     def __repr__(self) -> str:
         node = self.last
@@ -128,194 +446,925 @@ class Waitingline:
             yield node
             node = node.next
 
+    def __len__(self) -> int:
+        return self.length
+
+    def __getstate__(self):
+        return {"customers": list(self)[::-1]}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for customer in state["customers"]:
+            self.enter_line(customer)
+
     def count_customers(self):
-        count = 1
-        node = self.last
-        while node.next is not None:
-            count += 1
-            node = node.next
-        return count
+        return self.length
+
+    def peek(self):
+        return self.first
 
     def quit_line(self):
-        node = self.last
-        while node.next is not None:
-            node_prev = node
-            node = node.next
-        node_prev.next = None
+        if self.first is None:
+            return None
+        return self.remove(self.first)
+
+    def remove(self, node: Customer):
+        if node.prev is None:
+            self.last = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is None:
+            self.first = node.prev
+        else:
+            node.next.prev = node.prev
+        node.next = None
+        node.prev = None
+        self.length -= 1
         return node
 
     def enter_line(self, new_node: Customer):
+        new_node.next = self.last
+        new_node.prev = None
         if self.last is None:
-            self.last = new_node
+            self.first = new_node
         else:
-            node = self.last
-            new_node.next = node
-            self.last = new_node
+            self.last.prev = new_node
+        self.last = new_node
+        self.length += 1
+
+
+class EventType(Enum):
+    arrival = 1
+    reach_counter = 2
+    order_decided = 3
+    drink_ready = 4
+    close_shop = 5
+
+
+class EventEngine:
+    """
+    Discrete-event clock. Events are kept in a heap ordered by their timestamp
+    (ties keep scheduling order) and the clock jumps from one event to the next.
+    """
+
+    def __init__(self, start_time: datetime) -> None:
+        self.time = start_time
+        self.events = []
+        self.handlers = {}
+        self.closed = False
+        self._sequence = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handlers"] = {}
+        state.pop("_sleep", None)
+        return state
+
+    def _sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def register(self, kind: EventType, handler):
+        self.handlers[kind] = handler
+
+    def schedule(self, at: datetime, kind: EventType, payload=None):
+        self._sequence += 1
+        heapq.heappush(self.events, (at, self._sequence, kind, payload))
+
+    def next_time(self):
+        return self.events[0][0] if self.events else None
+
+    def step(self):
+        at, _, kind, payload = heapq.heappop(self.events)
+        self.time = at
+        handler = self.handlers.get(kind)
+        if handler is not None:
+            handler(at, payload)
+        if kind is EventType.close_shop:
+            self.closed = True
+
+    def run(self, until: datetime = None, time_step: float = None):
+        """
+        Processes events up to and including `until` (all of them if None).
+        Without `time_step` the clock jumps straight to the next event. With it,
+        the engine sleeps `time_step` seconds per simulated minute between events.
+        """
+        while self.events and not self.closed:
+            at = self.events[0][0]
+            if until is not None and at > until:
+                break
+            if time_step:
+                self._sleep((at - self.time).total_seconds() / 60 * time_step)
+            self.step()
+        if until is not None and not self.closed and until > self.time:
+            self.time = until
+
+
+class DrinkQueue:
+    """
+    Pending drinks in a min-heap keyed by ready time (ties keep order of
+    placement). Indexing and iteration see the heap order, so [0] is always
+    the next drink to be ready.
+    """
+
+    def __init__(self) -> None:
+        self.heap = []
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __iter__(self):
+        return (entry[2] for entry in self.heap)
+
+    def __getitem__(self, index: int) -> Customer:
+        return self.heap[index][2]
+
+    def push(self, customer: Customer, ready_time: datetime):
+        self._sequence += 1
+        heapq.heappush(self.heap, (ready_time, self._sequence, customer))
+
+    def pop_ready(self, time: datetime):
+        while self.heap and self.heap[0][0] <= time:
+            yield heapq.heappop(self.heap)[2]
+
+
+class DispatchPolicy:
+    """
+    Pool of idle baristas. `pop` hands out the barista that takes the next
+    customer, the one with the smallest `key`; by default the earliest hired.
+    """
+
+    def __init__(self) -> None:
+        self.heap = []
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def key(self, barista: Barista):
+        return barista.hire_order
+
+    def push(self, barista: Barista):
+        heapq.heappush(self.heap, (self.key(barista), barista.hire_order, barista))
+
+    def pop(self) -> Barista:
+        return heapq.heappop(self.heap)[2]
+
+
+class FastestSkillPolicy(DispatchPolicy):
+    def key(self, barista: Barista):
+        return -barista.level.value
+
+
+class RoundRobinPolicy(DispatchPolicy):
+    """
+    The barista who has been idle the longest takes the next customer
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.turns = 0
+
+    def key(self, barista: Barista):
+        self.turns += 1
+        return self.turns
 
 
 class Rushhour:
-    def __init__(self, order_list: Waitingline) -> None:
+    def __init__(
+        self,
+        order_list: Waitingline,
+        prep_time: PrepTime = PrepTime.per_tick,
+        policy: DispatchPolicy = None,
+        rng: RandomStreams = None,
+    ) -> None:
+        """
+        Every drink gets its ready time when it is ordered, drawn from `rng`
+        as set by `prep_time`, and waits in `drink_wait_list` ordered by that time.
+        Idle baristas wait in `policy`, which decides who takes the next
+        customer, and busy ones sit in the `decisions` heap keyed by the time
+        their customer will have decided.
+        """
         self.order_list = order_list
+        self.prep_time = prep_time
+        self.idle_baristas = policy if policy is not None else DispatchPolicy()
+        self.decisions = []
+        self._decision_sequence = 0
         self.barista_list = []
-        self.drink_wait_list = []
+        self.drink_wait_list = DrinkQueue()
+        self.rng = rng if rng is not None else RandomStreams()
+        self.engine = None
+        self.logger = None
+        self.metrics: ShopMetrics = None
+        self.sink: EventSink = None
+        self.trace: TraceWriter = None
+        self.served = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("engine", "logger", "sink", "trace"):
+            state[name] = None
+        return state
 
     def add_barista(self, barista: Barista):
+        barista.hire_order = len(self.barista_list)
         self.barista_list.append(barista)
+        self.idle_baristas.push(barista)
+        if self.engine is not None:
+            self._dispatch(self.engine.time)
+
+    def attach(self, engine: EventEngine, logger: logging.Logger):
+        """
+        Drives this rush hour from the events of `engine` instead of ticks
+        """
+        self.engine = engine
+        self.logger = logger
+        engine.register(EventType.arrival, self.on_arrival)
+        engine.register(EventType.reach_counter, self.on_reach_counter)
+        engine.register(EventType.order_decided, self.on_order_decided)
+        engine.register(EventType.drink_ready, self.on_drink_ready)
+
+    def _dispatch(self, time: datetime):
+        while self.order_list and self.idle_baristas:
+            b = self.idle_baristas.pop()
+            b.customer = self.order_list.quit_line()
+            self.engine.schedule(time, EventType.reach_counter, b)
+
+    def add_customer(self, customer: Customer, time: datetime):
+        """
+        Puts `customer` at the end of the line, recording the arrival. Ticks
+        take them from there; with an engine attached use on_arrival.
+        """
+        if self.metrics is not None:
+            self.metrics.record_arrival(customer, time)
+        if self.sink is not None and self.sink.enabled(logging.DEBUG):
+            self.sink.emit(logging.DEBUG, "arrival", time, customer.position_in_row)
+        self.order_list.enter_line(customer)
+
+    def on_arrival(self, time: datetime, customer: Customer):
+        self.add_customer(customer, time)
+        self._dispatch(time)
+
+    def on_reach_counter(self, time: datetime, barista: Barista):
+        self._reach_counter(barista, time, self.logger)
+        self.engine.schedule(
+            time + timedelta(seconds=barista.customer.character.value[0]),
+            EventType.order_decided,
+            barista,
+        )
+
+    def on_order_decided(self, time: datetime, barista: Barista):
+        customer = self._take_order(barista, time, self.logger)
+        self.engine.schedule(customer.ready_time, EventType.drink_ready, customer)
+        self._dispatch(time)
+
+    def on_drink_ready(self, time: datetime, customer: Customer):
+        """
+        Serves every drink ready by now; drinks sharing a ready time are all
+        served by the first of their events
+        """
+        for c in self.drink_wait_list.pop_ready(time):
+            self._serve(c, time, self.logger)
+            self.served.append(c)
+
+    def _reach_counter(self, barista: Barista, time: datetime, logger: logging.Logger):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("A barista is free a customer is sent to be served")
+        customer = barista.customer
+        customer.order_start_time = time
+        customer.status = Status.ordering
+        customer.barista = barista
+        if self.metrics is not None:
+            self.metrics.record_counter(customer, barista, time)
+        if self.sink is not None and self.sink.enabled(logging.DEBUG):
+            self.sink.emit(logging.DEBUG, "counter", time, customer.position_in_row, barista.level.name)
+
+    def _take_order(self, barista: Barista, time: datetime, logger: logging.Logger):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("The customer has made a decision and they are ordering their drink")
+        customer = barista.customer
+        customer.status = Status.waiting_for_drink
+        customer.order_time = time
+        customer.order = barista.choose_drink(self.rng.drinks.at(customer.position_in_row))
+        if self.metrics is not None:
+            self.metrics.record_order(customer, barista, time)
+        if self.sink is not None and self.sink.enabled(logging.DEBUG):
+            self.sink.emit(logging.DEBUG, "order", time, customer.position_in_row, customer.order.name)
+        self.drink_wait_list.push(customer, self._ready_time(customer))
+        barista.customer = None
+        self.idle_baristas.push(barista)
+        return customer
+
+    def _serve(self, c: Customer, time: datetime, logger: logging.Logger):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Arrival: %s | In front of barista: %s | Ordering time: %s | Order: %s | Time to ready: %s",
+                c.arrival_time,
+                c.order_start_time,
+                c.order_time,
+                c.order.name,
+                time - c.order_time,
+            )
+        if self.metrics is not None:
+            self.metrics.record_served(c, time)
+        if self.sink is not None and self.sink.enabled(logging.INFO):
+            self.sink.emit(logging.INFO, "served", time, c.position_in_row, c.order.name)
+        if self.trace is not None:
+            self.trace.record(c, time)
+
+    def _ready_time(self, customer: Customer) -> datetime:
+        if self.prep_time is PrepTime.sampled:
+            customer.ready_time = customer.sample_ready_time(
+                self.rng.prep_time.at(customer.position_in_row)
+            )
+        else:
+            customer.ready_time = customer.drink_ready_time(self.rng.prep_time)
+        return customer.ready_time
 
     def find_barista_and_order(self, time: datetime, logger:logging):
-        for b in self.barista_list:
-            if b.customer is None:
-                logger.info("A barista is free a customer is sent to be served")
-                b.customer = self.order_list.quit_line()
-                b.customer.order_start_time = time
-                b.customer.status = Status.ordering
-            else:
-                waited_time = time - b.customer.order_start_time
-                if waited_time.total_seconds() >= b.customer.character.value[0]:
-                    logger.info("The customer has made a decision and they are ordering their drink")
-                    b.customer.status = Status.waiting_for_drink
-                    b.customer.order_time = time
-                    b.customer.order = b.__dict__[random.choice(b.drink_list)]
-                    self.drink_wait_list.append(b.customer)
-                    b.customer = None
-                else:
-                    logger.info("The barista has a customer but the customer is still indecisive.")
+        """
+        Sends waiting customers to idle baristas, then takes the orders of
+        every customer whose decision time has come. Baristas freed by an
+        order take their next customer on the following tick.
+        """
+        while self.order_list and self.idle_baristas:
+            b = self.idle_baristas.pop()
+            b.customer = self.order_list.quit_line()
+            self._reach_counter(b, time, logger)
+            self._decision_sequence += 1
+            heapq.heappush(
+                self.decisions,
+                (
+                    time + timedelta(seconds=b.customer.character.value[0]),
+                    self._decision_sequence,
+                    b,
+                ),
+            )
+        while self.decisions and self.decisions[0][0] <= time:
+            self._take_order(heapq.heappop(self.decisions)[2], time, logger)
 
     def serve_drink_wait_list(self, time, logger):
         to_exit = []
-        for c in self.drink_wait_list[-1:]:
-            k = c.is_drink_ready(time)
-            if k == 1:
-                self.drink_wait_list.pop()
-                logger.info(
-                    f"Arrival: {c.arrival_time} | In front of barista: {c.order_start_time} | Ordering time: {c.order_time} | Order: {c.order.name} | Time to ready: {time - c.order_time}"
-                )
-                to_exit.append(c.position_in_row)
+        for c in self.drink_wait_list.pop_ready(time):
+            self._serve(c, time, logger)
+            to_exit.append(c.position_in_row)
         return to_exit
 
 
-class Container(containers.DeclarativeContainer):
-    barista_factory = providers.Factory(
-        Barista, csv_file=providers.Dependency(), level=providers.Dependency()
-    )
+def replicate(menu_path, n, arrivals, baristas, seed=None, first=0):
+    """
+    Runs `n` independent rush hours of the `menu_path` menu at once, with
+    every customer and barista held as NumPy arrays of shape (n, ...). `arrivals` is a sequence of
+    (minutes after opening, Character) and `baristas` a sequence of Skill.
+    Customers are served first come first served by the first idle barista
+    (in hiring order), or else by the barista that frees up first, exactly
+    like the event engine in `PrepTime.sampled` mode.
+
+    Replication r draws from RandomStreams(spawn_seed(seed, r)), exactly what
+    a Simulation with that seed draws for the same customers, and `first`
+    numbers the replications from there, so splitting a run into chunks
+    (across processes, say) does not change any result.
+
+    Returns a dict of (n, customers) arrays in minutes: queue_time,
+    ordering_time and prep_time, plus the drink and barista indices.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    arrivals = sorted(arrivals, key=lambda a: a[0])
+    arrival = np.array([a[0] for a in arrivals], dtype=float)
+    delay = np.array([a[1].value[0] / 60 for a in arrivals], dtype=float)
+    menu = menu_registry.get(menu_path)
+    drink_list = menu.drink_list
+    levels = [level.value - 1 for level in baristas]
+    mu = menu.mu[levels]
+    std = menu.std[levels]
 
-    customer_factory = providers.Factory(
-        Customer,
-        position_in_row=providers.Dependency(),
-        arrival_time=providers.Dependency(),
+    m = len(arrival)
+    rows = np.arange(n)
+    free_at = np.zeros((n, len(levels)))
+    queue_time = np.empty((n, m))
+    ordering_time = np.broadcast_to(delay, (n, m)).copy()
+    barista = np.empty((n, m), dtype=np.int64)
+    for i in range(m):
+        idle = free_at <= arrival[i]
+        pick = np.where(
+            idle.any(axis=1), idle.argmax(axis=1), free_at.argmin(axis=1)
+        )
+        start = np.maximum(arrival[i], free_at[rows, pick])
+        queue_time[:, i] = start - arrival[i]
+        free_at[rows, pick] = start + delay[i]
+        barista[:, i] = pick
+    streams = [RandomStreams(spawn_seed(seed, r)) for r in range(first, first + n)]
+    drink = (
+        np.array([s.drinks.take(m) for s in streams]).reshape(n, m) * len(drink_list)
+    ).astype(np.int64)
+    prep_time = _truncated_normal_ppf(
+        mu[barista, drink],
+        std[barista, drink],
+        np.array([s.prep_time.take(m) for s in streams]).reshape(n, m),
     )
+    return {
+        "queue_time": queue_time,
+        "ordering_time": ordering_time,
+        "prep_time": prep_time,
+        "drink": drink,
+        "barista": barista,
+    }
+
+
+@functools.cache
+def _container():
+    """
+    The dependency injection Container, defined on first use so importing the
+    model does not import dependency_injector
+    """
+    from dependency_injector import containers, providers
 
-    waiting_line_factory = providers.Factory(Waitingline)
+    class Container(containers.DeclarativeContainer):
+        barista_factory = providers.Factory(
+            Barista, csv_file=providers.Dependency(), level=providers.Dependency()
+        )
+
+        customer_factory = providers.Factory(
+            Customer,
+            position_in_row=providers.Dependency(),
+            arrival_time=providers.Dependency(),
+        )
 
-    rush_hour_factory = providers.Factory(Rushhour, order_list=providers.Dependency())
+        waiting_line_factory = providers.Factory(Waitingline)
+
+        rush_hour_factory = providers.Factory(Rushhour, order_list=providers.Dependency())
+
+    return Container
+
+
+def _pika():
+    """
+    The broker client, imported on first use
+    """
+    import pika
+    import pika.exceptions
+
+    return pika
+
+
+def __getattr__(name):
+    if name == "Container":
+        return _container()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _write_atomically(path, data: bytes):
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues the record untouched so that message formatting also happens on
+    the listener thread; the simulation only logs immutable arguments
+    """
+
+    def prepare(self, record):
+        return record
 
 
 class Simulation:
     def __init__(
-        self, menu_path, queue_name="run_simulation", host="localhost"
+        self,
+        menu_path,
+        queue_name="run_simulation",
+        host="localhost",
+        prep_time: PrepTime = PrepTime.per_tick,
+        logger: logging.Logger = None,
+        event_log=None,
+        event_log_level=logging.DEBUG,
+        trace=None,
+        snapshot_path=None,
+        snapshot_every: timedelta = timedelta(hours=1),
+        seed=None,
+        instrument=False,
+        profile=None,
+        profile_window=None,
+        append=False,
     ) -> None:
+        """
+        seed: every random draw comes from RandomStreams(seed), None for fresh entropy
+        logger: defaults to my_logger.out in the working directory
+        event_log: JSON lines file of the events at or above event_log_level
+        trace: directory of the columnar trace of served customers
+        snapshot_path: state saved there every snapshot_every, see resume
+        instrument: times the loop phases and samples gauges, see stats
+        profile: cProfile dump path for the profile_window of simulated time
+        append: continues the log files instead of replacing them
+        """
         self.queue_name = queue_name
+        self.prep_time = prep_time
         self.host = host
+        self.broker: RabbitMQSource = None
         self.connection = None
         self.channel = None
         self.time = datetime(2024, 10, 10, 8, 0, 0)
         self.csv_path = menu_path
-        self.container = Container()
+        self.container = _container()()
         self.customer_number = 0
+        self.customers = CustomerStore()
+        self.metrics = ShopMetrics()
+        self.rng = RandomStreams(seed)
+        self.deliveries = []
+        self.logger = logger if logger is not None else self._file_logger(append)
+        self.event_sink = (
+            EventSink(event_log, level=event_log_level, append=append)
+            if event_log
+            else None
+        )
+        self.trace = TraceWriter(trace) if trace else None
+        self.engine: EventEngine = None
+        self.rush_hour: Rushhour = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.last_snapshot = None
+        self._last_snapshot_time = self.time
+        self._snapshot_writer = None
+        self._resumed = False
+        self.instruments = None
+        if instrument or profile:
+            self._instrument(Instruments(profile, profile_window))
+
+    def _instrument(self, instruments: Instruments):
+        """
+        Swaps the timed versions of the loop phases in on this instance only
+        """
+        self.instruments = instruments
+        self.logger = TimedLogger(self.logger, instruments)
+        if self.event_sink is not None:
+            self.event_sink.emit = instruments.timed("logging", self.event_sink.emit)
+        for phase, name in (
+            ("intake", "_poll"),
+            ("intake", "_wait_for_deliveries"),
+            ("apply", "apply_message"),
+            ("release", "_release_customers"),
+            ("snapshot", "snapshot"),
+            ("sleep", "_sleep"),
+        ):
+            setattr(self, name, instruments.timed(phase, getattr(self, name)))
+
+    def _instrument_engine(self, engine: EventEngine):
+        if self.instruments is None:
+            return
+        for kind, phase in (
+            (EventType.arrival, "dispatch"),
+            (EventType.reach_counter, "dispatch"),
+            (EventType.order_decided, "dispatch"),
+            (EventType.drink_ready, "drinks"),
+        ):
+            engine.handlers[kind] = self.instruments.timed(phase, engine.handlers[kind])
+        engine._sleep = self.instruments.timed("sleep", engine._sleep)
+
+    def _sample(self, engine: EventEngine, rush_hour: Rushhour):
+        self.instruments.sample(
+            queue_length=len(rush_hour.order_list),
+            busy_baristas=len(rush_hour.barista_list) - len(rush_hour.idle_baristas),
+            drink_backlog=len(rush_hour.drink_wait_list),
+            pending_events=len(engine.events),
+        )
+        self.instruments.profile_at(self.time)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the shop: simulated time, customers inside, event counts
+        and current gauges, plus phase timings and gauge statistics when
+        instrumented
+        """
+        rush_hour = self.rush_hour
+        gauges = {
+            "queue_length": len(rush_hour.order_list) if rush_hour else 0,
+            "busy_baristas": (
+                len(rush_hour.barista_list) - len(rush_hour.idle_baristas) if rush_hour else 0
+            ),
+            "drink_backlog": len(rush_hour.drink_wait_list) if rush_hour else 0,
+            "pending_events": len(self.engine.events) if self.engine else 0,
+        }
+        stats = {
+            "time": self.time,
+            "customers": len(self.customers),
+            "events": dict(self.metrics.events),
+            "phases": {},
+            "gauges": {name: {"current": value} for name, value in gauges.items()},
+        }
+        if self.instruments is not None:
+            stats.update(self.instruments.snapshot())
+            for name, value in gauges.items():
+                stats["gauges"][name]["current"] = value
+        return stats
+
+    _log_listener: logging.handlers.QueueListener = None
+
+    @staticmethod
+    def _file_logger(append=False):
         # ====================== Logger ======================
         save_path = os.path.join(os.getcwd(), "my_logger.out")
-        if os.path.exists(save_path):
-            for handler in logging.getLogger("CoffeeShopLogger").handlers:
-                handler.close()
+        logger = logging.getLogger("CoffeeShopLogger")
+        Simulation._stop_log_listener()
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+        if os.path.exists(save_path) and not append:
             os.remove(save_path)
-        self.logger = logging.getLogger("CoffeeShopLogger")
-        self.logger.setLevel(logging.INFO)
+        logger.setLevel(logging.INFO)
         file_handler = logging.FileHandler(save_path)
         file_handler.setLevel(logging.INFO)
         formatter = logging.Formatter("%(levelname)s - %(message)s")
         file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        records = queue.SimpleQueue()
+        logger.addHandler(_DeferredQueueHandler(records))
+        Simulation._log_listener = logging.handlers.QueueListener(records, file_handler)
+        Simulation._log_listener.start()
+        atexit.register(Simulation._stop_log_listener)
+        return logger
+
+    @staticmethod
+    def _stop_log_listener():
+        listener = Simulation._log_listener
+        if listener is None:
+            return
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        Simulation._log_listener = None
+        atexit.unregister(Simulation._stop_log_listener)
 
     def connect(self):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
-        self.channel = self.connection.channel()
+        self.broker = RabbitMQSource(self.queue_name, self.host)
+        self.broker.connect()
+        self.connection = self.broker.connection
+        self.channel = self.broker.channel
 
     def declare_queue(self):
-        self.channel.queue_declare(queue=self.queue_name, durable=True)
+        self.broker.declare_queue()
 
-    def open_shop(self, time_step, logger):
+    def open_shop(self, time_step=0, logger=None, prefetch_count=None):
+        """
+        Consumes the broker queue, one simulated minute per loop. Messages are
+        applied at the current simulated time and the event engine resolves
+        everything that happens in between. `time_step` is the real-time pacing
+        in seconds per simulated minute, 0 runs as fast as possible.
+
+        By default the queue is polled with basic_get, one message per minute.
+        With `prefetch_count` the broker pushes up to that many unacked messages,
+        all of them are applied as one batch and acknowledged once applied.
+        While nothing is in flight the loop blocks on the connection instead of
+        spinning.
+        """
         self.connect()
         self.declare_queue()
 
-        self.logger.info(f"Connection with RMQ is established ...\nStore Opened at {self.time}")
-        waiting_line = self.container.waiting_line_factory()
-        rush_hour = self.container.rush_hour_factory(order_list=waiting_line)
-        while True:
-            method_frame, properties, body = self.channel.basic_get(
-                queue=self.queue_name, auto_ack=True
+        self.logger.info("Connection with RMQ is established ...\nStore Opened at %s", self.time)
+        engine, rush_hour = self._build_engine()
+        if prefetch_count:
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+            self.channel.basic_consume(
+                queue=self.queue_name, on_message_callback=self._on_delivery
             )
+        while not engine.closed:
+            engine.run(until=self.time)
+            if self.instruments is not None:
+                self._sample(engine, rush_hour)
+            self._maybe_snapshot()
+            if prefetch_count:
+                self._drain_deliveries(engine, rush_hour, time_step)
+            else:
+                message_dict = self._poll()
+                if message_dict is not None:
+                    self.apply_message(engine, rush_hour, message_dict)
+                if time_step:
+                    self._sleep(time_step)
+            engine.run(until=self.time)
+            self._release_customers(rush_hour)
+            if engine.closed:
+                return
+            self.time += timedelta(minutes=1)
 
-            if method_frame:
-                message = body.decode()
-                message_dict = json.load(message)
-
-                if message_dict["barista"]["count"] > 0:
-                    for b in message_dict["barista"]["employees"]:
-                        level = b["level_index"]
-                        barista = self.container.barista_factory(
-                            csv_file=self.csv_path, level=Status(level)
-                        )
-                        rush_hour.add_barista(barista=barista)
-                        self.logger.info(
-                            f"Adding a barista to rush hour. The barista level is {level}"
-                        )
-                if message_dict["customer"]["count"] > 0:
-                    for c in message_dict["customer"]["people"]:
-                        globals()[f"customer{self.customer_number}"] = (
-                            self.container.customer_factory(
-                                position_in_row=self.customer_number,
-                                character=Character(c["character_index"]),
-                                arrival_time=self.time,
-                            )
-                        )
-                        waiting_line.enter_line(
-                            globals()[f"customer{self.customer_number}"]
-                        )
-                        self.customer_number += 1
-                        self.logger.info(f"Adding a customer to the waiting line. The customer character is : {c["character_index"]}")
-
-                rush_hour.find_barista_and_order(time=self.time)
-                customer_exit: list = rush_hour.serve_drink_wait_list(
-                    time=self.time, logger=self.logger
+    def _poll(self):
+        return self.broker.poll()
+
+    def _sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def _on_delivery(self, channel, method, properties, body):
+        self.deliveries.append((method.delivery_tag, body))
+
+    def _wait_for_deliveries(self, time_limit):
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def _drain_deliveries(self, engine: EventEngine, rush_hour: Rushhour, time_step):
+        idle = not self.deliveries and not engine.events
+        self._wait_for_deliveries(None if idle and not time_step else time_step)
+        batch, self.deliveries = self.deliveries, []
+        for _, body in batch:
+            self.apply_message(engine, rush_hour, json.loads(body.decode()))
+        if batch:
+            self.channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+
+    def simulate(self, timed_messages, time_step=None):
+        """
+        Runs the shop from an iterable of (datetime, message_dict) pairs sorted
+        by time, without a broker. The clock jumps from event to event unless a
+        `time_step` pacing is given.
+        """
+        self.logger.info("Store Opened at %s", self.time)
+        engine, rush_hour = self._build_engine()
+        if self.instruments is not None:
+            timed_messages = self.instruments.timed_iter("intake", timed_messages)
+        for at, message_dict in timed_messages:
+            engine.run(until=at, time_step=time_step)
+            self._release_customers(rush_hour)
+            if engine.closed:
+                return rush_hour
+            self.time = at
+            if self.instruments is not None:
+                self._sample(engine, rush_hour)
+            self._maybe_snapshot()
+            self.apply_message(engine, rush_hour, message_dict)
+        engine.run(time_step=time_step)
+        self._release_customers(rush_hour)
+        if self.instruments is not None:
+            self.instruments.dump_profile()
+        if self.event_sink is not None:
+            self.event_sink.flush()
+        if self.trace is not None:
+            self.trace.flush()
+        return rush_hour
+
+    def _build_engine(self):
+        if self._resumed:
+            self._resumed = False
+            return self.engine, self.rush_hour
+        engine = EventEngine(self.time)
+        waiting_line = self.container.waiting_line_factory()
+        rush_hour = self.container.rush_hour_factory(
+            order_list=waiting_line, prep_time=self.prep_time
+        )
+        rush_hour.metrics = self.metrics
+        rush_hour.rng = self.rng
+        rush_hour.sink = self.event_sink
+        rush_hour.trace = self.trace
+        rush_hour.attach(engine, self.logger)
+        engine.register(EventType.close_shop, self._on_close)
+        self._instrument_engine(engine)
+        self.engine = engine
+        self.rush_hour = rush_hour
+        return engine, rush_hour
+
+    def _maybe_snapshot(self):
+        if (
+            self.snapshot_path is not None
+            and self.time - self._last_snapshot_time >= self.snapshot_every
+        ):
+            self.snapshot()
+
+    def snapshot(self, path=None):
+        """
+        Pickles the clock, event queue, rush hour (line, baristas, pending
+        drinks), customers, metrics and RNG states. Only the pickling happens
+        here, its cost bounded by the customers currently in the shop, plus a
+        flush of the trace so its chunks on disk match the snapshot; a
+        background thread writes the file atomically. Returns the future of
+        that write.
+        """
+        state = {
+            "version": 1,
+            "time": self.time,
+            "menu_path": self.csv_path,
+            "queue_name": self.queue_name,
+            "prep_time": self.prep_time,
+            "customer_number": self.customer_number,
+            "customers": self.customers,
+            "metrics": self.metrics,
+            "engine": self.engine,
+            "rush_hour": self.rush_hour,
+            "rng": self.rng,
+            "trace": self.trace.checkpoint() if self.trace is not None else None,
+        }
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._snapshot_writer is None:
+            self._snapshot_writer = ThreadPoolExecutor(max_workers=1)
+        self._last_snapshot_time = self.time
+        self.last_snapshot = self._snapshot_writer.submit(
+            _write_atomically, path or self.snapshot_path, data
+        )
+        return self.last_snapshot
+
+    @classmethod
+    def resume(cls, path, **kwargs):
+        """
+        Rebuilds a shop from a snapshot file. The next open_shop or simulate
+        carries on from the saved clock with the saved line, baristas and
+        pending events instead of starting an empty shop. The log, event log
+        and trace of the crashed run are continued, not overwritten.
+        """
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+        kwargs.setdefault("queue_name", state["queue_name"])
+        kwargs.setdefault("prep_time", state["prep_time"])
+        simulation = cls(state["menu_path"], append=True, **kwargs)
+        if simulation.trace is not None and state.get("trace") is not None:
+            simulation.trace.restore(state["trace"])
+        simulation.time = state["time"]
+        simulation._last_snapshot_time = state["time"]
+        simulation.customer_number = state["customer_number"]
+        simulation.customers = state["customers"]
+        simulation.metrics = state["metrics"]
+        simulation.rng = state["rng"]
+        engine = state["engine"]
+        rush_hour = state["rush_hour"]
+        if engine is not None:
+            rush_hour.metrics = simulation.metrics
+            rush_hour.rng = simulation.rng
+            rush_hour.sink = simulation.event_sink
+            rush_hour.trace = simulation.trace
+            rush_hour.attach(engine, simulation.logger)
+            engine.register(EventType.close_shop, simulation._on_close)
+            simulation._instrument_engine(engine)
+            simulation.engine = engine
+            simulation.rush_hour = rush_hour
+            simulation._resumed = True
+        return simulation
+
+    def _on_close(self, time, payload):
+        self.time = time
+        self.close_shop()
+        self.logger.info("Closing the store at time %s", time)
+
+    def _release_customers(self, rush_hour: Rushhour):
+        for customer in rush_hour.served:
+            self.customers.remove(customer.id)
+        rush_hour.served.clear()
+
+    def apply_message(self, engine: EventEngine, rush_hour: Rushhour, message_dict):
+        if message_dict.get("barista", {}).get("count", 0) > 0:
+            for b in message_dict["barista"]["employees"]:
+                level = b["level_index"]
+                barista = self.container.barista_factory(
+                    csv_file=self.csv_path, level=Skill(level)
                 )
-                if customer_exit:
-                    for number in customer_exit:
-                        del globals()[f"customer{number}"]
-                if message_dict["close the store"].lower() == "true":
-                    self.close_shop()
-                    self.logger.info(f"Closing the store at time {self.time}")
-                    return
+                rush_hour.add_barista(barista=barista)
+                self.logger.info(
+                    "Adding a barista to rush hour. The barista level is %s", level
+                )
+        if message_dict.get("customer", {}).get("count", 0) > 0:
+            for c in message_dict["customer"]["people"]:
+                customer = self.container.customer_factory(
+                    position_in_row=self.customer_number,
+                    character=Character.from_index(c["character_index"]),
+                    arrival_time=engine.time,
+                )
+                self.customers.insert(customer)
+                engine.schedule(engine.time, EventType.arrival, customer)
+                self.customer_number += 1
+                self.logger.info(
+                    "Adding a customer to the waiting line. The customer character is : %s",
+                    c["character_index"],
+                )
+        if closes_store(message_dict):
+            engine.schedule(engine.time, EventType.close_shop)
 
-                time.sleep(time_step)
-            else:
-                time.sleep(time_step)
+    def replay(self, source: "MessageSource", time_step=None):
+        """
+        Runs the shop from a MessageSource, as fast as possible unless a
+        `time_step` pacing is given. A source with a seed replaces the random
+        streams first, so replaying the same capture gives the same run; a
+        resumed shop keeps the streams of its snapshot.
+        """
+        source.open()
+        try:
+            if source.seed is not None and not self._resumed:
+                self.rng = RandomStreams(source.seed)
+                if self.rush_hour is not None:
+                    self.rush_hour.rng = self.rng
+            return self.simulate(source.messages(self.time), time_step=time_step)
+        finally:
+            source.close()
 
-            self.time += timedelta(minutes=1)
+    def run_replications(self, n, arrivals, baristas, seed=None):
+        """
+        Vectorized Monte Carlo over `n` rush hours with this menu, see `replicate`
+        """
+        return replicate(self.csv_path, n, arrivals, baristas, seed)
 
-    def consuming_test(self, max_iterations=None):
+    def consuming_test(self, max_iterations=None, idle_wait=0.1):
         self.connect()
         self.declare_queue()
 
         try:
             iterations = 0
             while True:
-                method_frame, properties, body = self.channel.basic_get(
-                    queue=self.queue_name, auto_ack=True
-                )
+                message_dict = self._poll()
 
-                if method_frame:
-                    message = body.decode()
-                    message_dict = json.loads(message)
+                if message_dict is not None:
                     print(message_dict)
 
                     if max_iterations is not None:
@@ -323,13 +1372,334 @@ class Simulation:
                         if iterations >= max_iterations:
                             break
                 else:
-                    pass
+                    self.connection.process_data_events(time_limit=idle_wait)
         except KeyboardInterrupt:
             exit()
 
     def close_shop(self):
         if self.connection and not self.connection.is_closed:
             self.connection.close()
+        if self.event_sink is not None:
+            self.event_sink.close()
+        if self.trace is not None:
+            self.trace.close()
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.shutdown(wait=True)
+            self._snapshot_writer = None
+        if self.instruments is not None:
+            self.instruments.dump_profile()
+
+
+def closes_store(message_dict) -> bool:
+    return str(message_dict.get("close the store", "false")).lower() == "true"
+
+
+class MessageSource(ABC):
+    """
+    Where Simulation.replay takes its messages from. `messages(start)` yields
+    (datetime, message_dict) pairs in time order, the first one no earlier than
+    `start`, and stops after a message closing the store.
+    """
+
+    seed = None
+
+    def open(self):
+        pass
+
+    @abstractmethod
+    def messages(self, start: datetime):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlReplaySource(MessageSource):
+    """
+    Streams a capture written by `write`, one JSON object per line, without
+    loading the file. A line is either {"time": iso, "message": {...}} or a
+    bare message dict, which is taken one simulated minute after the previous
+    one like a polled queue. An optional first line {"seed": n} records the
+    seed of the run; a `seed` argument overrides it.
+    """
+
+    def __init__(self, path, seed=None) -> None:
+        self.path = path
+        self.seed = seed
+        self._file = None
+        self._header = None
+
+    def open(self):
+        self._file = open(self.path)
+        first = self._file.readline()
+        record = json.loads(first) if first.strip() else {}
+        if record.keys() == {"seed"}:
+            if self.seed is None:
+                self.seed = record["seed"]
+        else:
+            self._header = first
+
+    def messages(self, start: datetime):
+        if self._file is None:
+            self.open()
+        lines = self._file if self._header is None else itertools.chain(
+            [self._header], self._file
+        )
+        at = None
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "message" in record:
+                at = datetime.fromisoformat(record["time"])
+                message_dict = record["message"]
+                if at < start:
+                    continue
+            else:
+                at = start if at is None else at + timedelta(minutes=1)
+                message_dict = record
+            yield at, message_dict
+            if closes_store(message_dict):
+                return
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def write(path, timed_messages, seed=None):
+        """
+        Captures (datetime, message_dict) pairs in the format read back by
+        JsonlReplaySource
+        """
+        with open(path, "w") as file:
+            if seed is not None:
+                file.write(f'{json.dumps({"seed": seed})}\n')
+            for at, message_dict in timed_messages:
+                file.write(
+                    f'{json.dumps({"time": at.isoformat(), "message": message_dict})}\n'
+                )
+
+
+class RabbitMQSource(MessageSource):
+    """
+    Polls `queue_name` with basic_get, one poll per simulated minute, so a
+    replay of a live queue sees messages at the same times open_shop would;
+    open_shop polls through this class too. Empty polls wait `idle_wait`
+    seconds on the connection.
+    """
+
+    def __init__(self, queue_name="run_simulation", host="localhost", idle_wait=0.1):
+        self.queue_name = queue_name
+        self.host = host
+        self.idle_wait = idle_wait
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        pika = _pika()
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+        self.channel = self.connection.channel()
+
+    def declare_queue(self):
+        self.channel.queue_declare(queue=self.queue_name, durable=True)
+
+    def open(self):
+        self.connect()
+        self.declare_queue()
+
+    def poll(self):
+        """
+        The next message of the queue, or None when it is empty
+        """
+        method_frame, properties, body = self.channel.basic_get(
+            queue=self.queue_name, auto_ack=True
+        )
+        return json.loads(body.decode()) if method_frame else None
+
+    def messages(self, start: datetime):
+        at = start
+        while True:
+            message_dict = self.poll()
+            if message_dict is not None:
+                yield at, message_dict
+                if closes_store(message_dict):
+                    return
+            else:
+                self.connection.process_data_events(time_limit=self.idle_wait)
+            at += timedelta(minutes=1)
+
+    def close(self):
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
+
+
+class AsyncQueueSource:
+    """
+    In-memory message source for AsyncSimulation backed by an asyncio.Queue of
+    message dicts. Broker backed sources implement the same coroutines.
+    """
+
+    def __init__(self, queue: asyncio.Queue = None) -> None:
+        self.queue = queue if queue is not None else asyncio.Queue()
+
+    async def open(self):
+        pass
+
+    async def receive(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (forever with None, not at all with 0)
+        for a message and returns every message pending by then
+        """
+        batch = []
+        if timeout != 0:
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except TimeoutError:
+                return batch
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def ack(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class AsyncRabbitMQSource(AsyncQueueSource):
+    """
+    Consumes `queue_name` over pika's asyncio adapter. Deliveries are buffered
+    in the in-memory queue and acknowledged once the shop has applied them.
+    """
+
+    def __init__(self, queue_name="run_simulation", host="localhost", prefetch_count=100):
+        super().__init__()
+        self.queue_name = queue_name
+        self.host = host
+        self.prefetch_count = prefetch_count
+        self.connection = None
+        self.channel = None
+        self.delivery_tag = None
+
+    async def open(self):
+        from pika.adapters.asyncio_connection import AsyncioConnection
+
+        pika = _pika()
+
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+
+        def on_open_error(connection, error):
+            if not isinstance(error, Exception):
+                error = pika.exceptions.AMQPConnectionError(error)
+            opened.set_exception(error)
+
+        self.connection = AsyncioConnection(
+            pika.ConnectionParameters(self.host),
+            on_open_callback=lambda connection: connection.channel(
+                on_open_callback=opened.set_result
+            ),
+            on_open_error_callback=on_open_error,
+            custom_ioloop=loop,
+        )
+        self.channel = await opened
+        declared = loop.create_future()
+        self.channel.queue_declare(
+            queue=self.queue_name, durable=True, callback=declared.set_result
+        )
+        await declared
+        qos = loop.create_future()
+        self.channel.basic_qos(prefetch_count=self.prefetch_count, callback=qos.set_result)
+        await qos
+        self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_delivery)
+
+    def _on_delivery(self, channel, method, properties, body):
+        self.delivery_tag = method.delivery_tag
+        self.queue.put_nowait(json.loads(body.decode()))
+
+    async def ack(self):
+        if self.delivery_tag is not None and self.queue.empty():
+            self.channel.basic_ack(delivery_tag=self.delivery_tag, multiple=True)
+            self.delivery_tag = None
+
+    async def close(self):
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
+
+
+class AsyncSimulation(Simulation):
+    """
+    A shop that runs as a coroutine, so many shops can share one event loop.
+    Messages come from an async `source` (AsyncQueueSource or a broker backed
+    one) and waiting for them never blocks the other shops.
+    """
+
+    def __init__(
+        self,
+        menu_path,
+        source: AsyncQueueSource,
+        queue_name="run_simulation",
+        logger: logging.Logger = None,
+        **kwargs,
+    ) -> None:
+        """
+        Other keyword arguments are those of Simulation
+        """
+        super().__init__(
+            menu_path,
+            queue_name=queue_name,
+            logger=logger or logging.getLogger(f"CoffeeShopLogger.{queue_name}"),
+            **kwargs,
+        )
+        self.source = source
+
+    async def open_shop(self, time_step=0):
+        """
+        Same loop as Simulation.open_shop with the prefetch consumer: one
+        simulated minute per pass, every pending message applied as a batch.
+        `time_step` is the pacing in seconds per simulated minute.
+        """
+        await self.source.open()
+        self.logger.info("Store Opened at %s", self.time)
+        engine, rush_hour = self._build_engine()
+        try:
+            while not engine.closed:
+                engine.run(until=self.time)
+                if self.instruments is not None:
+                    self._sample(engine, rush_hour)
+                self._maybe_snapshot()
+                idle = not engine.events
+                batch = await self.source.receive(
+                    None if idle and not time_step else time_step
+                )
+                for message_dict in batch:
+                    self.apply_message(engine, rush_hour, message_dict)
+                await self.source.ack()
+                engine.run(until=self.time)
+                self._release_customers(rush_hour)
+                if engine.closed:
+                    break
+                self.time += timedelta(minutes=1)
+                if not time_step:
+                    await asyncio.sleep(0)
+        finally:
+            await self.close()
+        return rush_hour
+
+    async def close(self):
+        await self.source.close()
+
+
+async def run_shops(simulations, time_step=0):
+    """
+    Runs every shop on the current event loop until all of them have closed
+    """
+    return await asyncio.gather(
+        *(simulation.open_shop(time_step=time_step) for simulation in simulations)
+    )
 
 
 class RabbitMQProducer:
@@ -355,30 +1725,94 @@ class RabbitMQProducer:
     }
     """
 
-    def __init__(self, queue_name="task_queue", host="localhost"):
+    def __init__(
+        self, queue_name="task_queue", host="localhost", confirm=False, retries=3
+    ):
+        """
+        The connection and channel are opened on the first publish and reused
+        afterwards. With `confirm` every publish waits for the broker ack.
+        Publishes that fail on a lost connection are retried on a new one up to
+        `retries` times.
+        """
         self.queue_name = queue_name
         self.host = host
+        self.confirm = confirm
+        self.retries = retries
         self.connection = None
         self.channel = None
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def retryable():
+        """
+        Errors after which a publish is retried on a new connection
+        """
+        pika = _pika()
+        return (
+            pika.exceptions.AMQPConnectionError,
+            pika.exceptions.ChannelClosed,
+            pika.exceptions.ChannelWrongStateError,
+        )
+
     def connect(self):
+        pika = _pika()
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
         self.channel = self.connection.channel()
+        if self.confirm:
+            self.channel.confirm_delivery()
+        self.declare_queue()
 
     def declare_queue(self):
         self.channel.queue_declare(queue=self.queue_name, durable=True)
 
     def send_message(self, message_dict):
-        self.connect()
-        self.declare_queue()
-        message = json.dumps(message_dict)
-
-        self.channel.basic_publish(
-            exchange="",
-            routing_key=self.queue_name,
-            body=message,
-            properties=pika.BasicProperties(
-                delivery_mode=2,
-            ),
-        )
-        self.connection.close()
+        self.send_many([message_dict])
+
+    def send_many(self, message_dicts):
+        """
+        Publishes the messages in order over the shared channel and returns how
+        many were sent. Unroutable or nacked messages raise and are not retried.
+        """
+        bodies = [json.dumps(message_dict) for message_dict in message_dicts]
+        properties = _pika().BasicProperties(delivery_mode=2)
+        retryable = self.retryable()
+        sent = 0
+        attempt = 0
+        while True:
+            try:
+                if self.channel is None:
+                    self.connect()
+                for body in bodies[sent:]:
+                    self.channel.basic_publish(
+                        exchange="",
+                        routing_key=self.queue_name,
+                        body=body,
+                        properties=properties,
+                    )
+                    sent += 1
+                return sent
+            except retryable:
+                self._drop_connection()
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+    def _drop_connection(self):
+        try:
+            if self.connection is not None and not self.connection.is_closed:
+                self.connection.close()
+        except _pika().exceptions.AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def close(self):
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
+        self.connection = None
+        self.channel = None
@@ -0,0 +1,504 @@
+"""
+Benchmarks of the simulation hot paths. Run from the app directory:
+
+    python -m Benchmark.benchmark [--quick] [--output results.json]
+                                  [--baseline Benchmark/baseline.json]
+                                  [--update-baseline] [--threshold 1.25]
+
+Every result is saved as JSON and compared to the baseline; a result more
+than `threshold` times worse than its baseline is reported as a regression
+and makes the run exit with status 1. Timings are first scaled by how much
+faster or slower the machine runs a fixed calibration workload than it did
+for the baseline, so a busy or throttled host does not fail a clean tree.
+Quick runs have their own baseline, Benchmark/baseline.quick.json, and a run
+is never compared to a baseline recorded in the other mode.
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+
+from BE_Coffee_Shop import (
+    Barista,
+    Character,
+    Customer,
+    Drink,
+    PrepTime,
+    RabbitMQProducer,
+    Rushhour,
+    Simulation,
+    Skill,
+    Waitingline,
+    _container,
+    _pika,
+    _truncated_normal_ppf,
+    menu_registry,
+)
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+QUICK_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.quick.json")
+START = datetime(2024, 10, 10, 8, 0)
+CHARACTERS = list(Character)
+
+# lower is better for seconds, higher for rates
+HIGHER_IS_BETTER = {"customers/s", "messages/s"}
+# not scaled by the calibration
+UNTIMED = {"MB"}
+
+
+def _quiet_logger():
+    logger = logging.getLogger("CoffeeShopBenchmark")
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    return logger
+
+
+@contextlib.contextmanager
+def _gc_disabled():
+    """
+    Collects what earlier sections left behind, then keeps the collector
+    off like timeit
+    """
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _best_of(repeat, run, number=1):
+    """
+    Smallest wall time in seconds of one call of `run`, over `repeat` rounds
+    of `number` calls, with the garbage collector off
+    """
+    best = float("inf")
+    with _gc_disabled():
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                run()
+            best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def _warm_up():
+    """
+    Imports what BE_Coffee_Shop defers to first use, so that no timed section
+    pays for it; import_cost measures the module import on its own
+    """
+    Drink("warm up", 5.0, 1.0).prep_minutes(0.5)
+    _truncated_normal_ppf(5.0, 1.0, 0.5)
+    _container()
+    _pika()
+
+
+def _calibration_work():
+    counts = {}
+    for i in range(20_000):
+        key = str(i % 97)
+        counts[key] = counts.get(key, 0) + 1
+    return sorted(counts.items())
+
+
+def calibrate(repeat):
+    """
+    Seconds of a fixed pure Python workload, the machine speed that the
+    timings of a run are compared at
+    """
+    return _best_of(repeat, _calibration_work, number=20)
+
+
+def _customers(n):
+    return [
+        Customer(i, CHARACTERS[i % len(CHARACTERS)], START) for i in range(n)
+    ]
+
+
+def waiting_line(sizes, repeat):
+    results = {}
+    for n in sizes:
+        customers = _customers(n)
+
+        def run():
+            line = Waitingline()
+            for customer in customers:
+                line.enter_line(customer)
+            while line.quit_line() is not None:
+                pass
+
+        seconds = _best_of(repeat, run, number=max(1, 10**5 // n))
+        results[f"waitingline.enter_quit.{n}"] = {
+            "value": seconds / n,
+            "unit": "s/customer",
+        }
+    return results
+
+
+def _rush_hour_round(menu_path, staff, queue, ticks, logger):
+    """
+    Mean seconds per call of find_barista_and_order and of
+    serve_drink_wait_list over `ticks` ticks of a fresh rush hour
+    """
+    rush_hour = Rushhour(Waitingline(), prep_time=PrepTime.sampled)
+    for _ in range(staff):
+        rush_hour.add_barista(Barista(menu_path, Skill.expert))
+    arrived = 0
+    order = serve = 0.0
+    now = START
+    for _ in range(ticks):
+        while len(rush_hour.order_list) < queue:
+            character = CHARACTERS[arrived % len(CHARACTERS)]
+            rush_hour.add_customer(Customer(arrived, character, now), now)
+            arrived += 1
+        started = time.perf_counter()
+        rush_hour.find_barista_and_order(now, logger)
+        ordered = time.perf_counter()
+        rush_hour.serve_drink_wait_list(now, logger)
+        order += ordered - started
+        serve += time.perf_counter() - ordered
+        now += timedelta(seconds=10)
+    return order / ticks, serve / ticks
+
+
+def rush_hour_ticks(menu_path, staff_sizes, queue_sizes, ticks, repeat):
+    """
+    Seconds per call of find_barista_and_order and serve_drink_wait_list,
+    ticking every 10 simulated seconds with the line topped up to `queue`
+    customers before every tick, best of `repeat` rounds
+    """
+    logger = _quiet_logger()
+    results = {}
+    for staff in staff_sizes:
+        for queue in queue_sizes:
+            with _gc_disabled():
+                rounds = [
+                    _rush_hour_round(menu_path, staff, queue, ticks, logger)
+                    for _ in range(repeat)
+                ]
+            key = f"staff{staff}.queue{queue}"
+            results[f"rushhour.find_barista_and_order.{key}"] = {
+                "value": min(order for order, _ in rounds),
+                "unit": "s/tick",
+            }
+            results[f"rushhour.serve_drink_wait_list.{key}"] = {
+                "value": min(serve for _, serve in rounds),
+                "unit": "s/tick",
+            }
+    return results
+
+
+def _write_menu(path, drinks):
+    rng = np.random.default_rng(drinks)
+    with open(path, "w") as file:
+        file.write("drink, mu, std\n")
+        for i in range(drinks):
+            file.write(f"Drink{i}, {rng.uniform(2, 8):.2f}, {rng.uniform(0.5, 2):.2f}\n")
+
+
+def barista_construction(directory, menu_sizes, baristas, repeat):
+    """
+    Cold is the first Barista of a menu (parsing the CSV), warm the following
+    ones served from the menu registry
+    """
+    results = {}
+    for drinks in menu_sizes:
+        path = os.path.join(directory, f"menu_{drinks}.csv")
+        _write_menu(path, drinks)
+
+        def cold():
+            menu_registry.menus.pop(os.path.abspath(path), None)
+            Barista(path, Skill.midlevel)
+
+        results[f"barista.cold.{drinks}_drinks"] = {
+            "value": _best_of(repeat, cold, number=max(1, 1000 // drinks)),
+            "unit": "s/barista",
+        }
+        seconds = _best_of(
+            repeat, lambda: [Barista(path, Skill.midlevel) for _ in range(baristas)]
+        )
+        results[f"barista.warm.{drinks}_drinks"] = {
+            "value": seconds / baristas,
+            "unit": "s/barista",
+        }
+    return results
+
+
+def end_to_end(menu_path, customer_counts, repeat):
+    """
+    Simulated customers per second of Simulation.simulate, one arrival every
+    10 seconds spread over six baristas
+    """
+    logger = _quiet_logger()
+    results = {}
+    for n in customer_counts:
+        employees = [{"level_index": level.value} for level in Skill] * 2
+        messages = [
+            (START, {"barista": {"count": len(employees), "employees": employees}})
+        ]
+        for i in range(0, n, 6):
+            people = [
+                {"character_index": (j % len(CHARACTERS)) + 1}
+                for j in range(i, min(i + 6, n))
+            ]
+            messages.append(
+                (
+                    START + timedelta(minutes=i // 6),
+                    {"customer": {"count": len(people), "people": people}},
+                )
+            )
+
+        def run():
+            Simulation(
+                menu_path, prep_time=PrepTime.sampled, logger=logger, seed=0
+            ).simulate(messages)
+
+        results[f"simulation.end_to_end.{n}"] = {
+            "value": n / _best_of(repeat, run),
+            "unit": "customers/s",
+        }
+    return results
+
+
+class _Channel:
+    def queue_declare(self, queue, durable):
+        pass
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        pass
+
+
+class _Connection:
+    """
+    Stands in for pika.BlockingConnection without a broker and, unlike a
+    MagicMock, without recording every call
+    """
+
+    is_closed = False
+
+    def __init__(self, parameters):
+        pass
+
+    def channel(self):
+        return _Channel()
+
+    def close(self):
+        pass
+
+
+def producer(message_counts, repeat):
+    """
+    Messages per second of RabbitMQProducer.send_many over one connection,
+    against a producer connected, declared and closed for every message.
+    BlockingConnection is mocked, so this is the client side cost only.
+    """
+    message = {"customer": {"count": 1, "people": [{"character_index": 1}]}}
+    results = {}
+    with mock.patch("pika.BlockingConnection", _Connection):
+        for n in message_counts:
+            messages = [message] * n
+
+            def batched():
+                with RabbitMQProducer() as rabbit:
+                    rabbit.send_many(messages)
+
+            def per_message():
+                for message_dict in messages:
+                    with RabbitMQProducer() as rabbit:
+                        rabbit.send_message(message_dict)
+
+            results[f"producer.send_many.{n}"] = {
+                "value": n / _best_of(repeat, batched),
+                "unit": "messages/s",
+            }
+            results[f"producer.connect_per_message.{n}"] = {
+                "value": n / _best_of(repeat, per_message),
+                "unit": "messages/s",
+            }
+    return results
+
+
+IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import BE_Coffee_Shop
+seconds = time.perf_counter() - started
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+except ImportError:
+    rss = None
+print(json.dumps({"seconds": seconds, "rss": rss}))
+"""
+
+
+def import_cost(repeat):
+    """
+    Wall time and peak RSS in MB of importing BE_Coffee_Shop in a fresh
+    interpreter, as every worker process does
+    """
+    runs = [
+        json.loads(
+            subprocess.run(
+                [sys.executable, "-c", "import json, sys" + IMPORT_SCRIPT],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+        for _ in range(repeat)
+    ]
+    results = {
+        "import.BE_Coffee_Shop": {
+            "value": min(run["seconds"] for run in runs),
+            "unit": "s",
+        }
+    }
+    if runs[0]["rss"] is not None:
+        results["import.BE_Coffee_Shop.max_rss"] = {
+            "value": min(run["rss"] for run in runs),
+            "unit": "MB",
+        }
+    return results
+
+
+def _better(result, other) -> bool:
+    if result["unit"] in HIGHER_IS_BETTER:
+        return result["value"] > other["value"]
+    return result["value"] < other["value"]
+
+
+def run_all(menu_path, quick=False):
+    """
+    Best result of every benchmark over `repeat` passes of the whole suite,
+    so a slow spell of the host spoils at most one pass of each
+    """
+    if quick:
+        line_sizes, staff, queues, ticks = [10**3, 10**4], [1, 10], [100], 50
+        menus, customers, messages, repeat = [10, 1000], [1000], [1000], 3
+    else:
+        line_sizes, staff, queues, ticks = [10**3, 10**4, 10**5, 10**6], [1, 10, 100], [100, 10_000], 500
+        menus, customers, repeat = [10, 1000, 10_000], [1000, 10_000, 100_000], 5
+        messages = [1000, 10_000]
+    _warm_up()
+    results = {}
+    calibration = float("inf")
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(repeat):
+            calibration = min(calibration, calibrate(1))
+            found = import_cost(1)
+            found.update(waiting_line(line_sizes, 1))
+            found.update(rush_hour_ticks(menu_path, staff, queues, ticks, 1))
+            found.update(barista_construction(directory, menus, 100, 1))
+            found.update(end_to_end(menu_path, customers, 1))
+            found.update(producer(messages, 1))
+            for name, result in found.items():
+                best = results.setdefault(name, result)
+                if _better(result, best):
+                    results[name] = result
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "quick": quick,
+            "calibration": calibration,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, threshold=1.25):
+    """
+    Ratio of every result to its baseline, oriented so that above 1 is worse.
+    Timing ratios are divided by the ratio of the two calibrations when both
+    sides have one. Returns (rows, regressions) where each row is (name,
+    value, baseline, ratio) and regressions are the rows with a ratio above
+    `threshold`. Raises ValueError if one was a quick run and the other was not.
+    """
+    quick = results.get("meta", {}).get("quick", False)
+    if "meta" in baseline and baseline["meta"].get("quick", False) != quick:
+        raise ValueError(
+            f"cannot compare a {'quick' if quick else 'full'} run to a "
+            f"{'full' if quick else 'quick'} baseline"
+        )
+    speed = 1.0
+    if "calibration" in results.get("meta", {}) and "calibration" in baseline.get("meta", {}):
+        speed = results["meta"]["calibration"] / baseline["meta"]["calibration"]
+    rows = []
+    for name, result in results["results"].items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            rows.append((name, result["value"], None, None))
+            continue
+        if result["unit"] in HIGHER_IS_BETTER:
+            ratio = reference["value"] / result["value"]
+        else:
+            ratio = result["value"] / reference["value"]
+        if result["unit"] not in UNTIMED:
+            ratio /= speed
+        rows.append((name, result["value"], reference["value"], ratio))
+    regressions = [row for row in rows if row[3] is not None and row[3] > threshold]
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--menu", default=os.path.join("Test", "test.csv"))
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    if args.baseline is None:
+        args.baseline = QUICK_BASELINE if args.quick else BASELINE
+    results = run_all(args.menu, quick=args.quick)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    try:
+        rows, regressions = compare(results, baseline, args.threshold)
+    except ValueError as error:
+        print(f"{args.baseline}: {error}")
+        return 2
+    for name, value, reference, ratio in rows:
+        unit = results["results"][name]["unit"]
+        versus = "no baseline" if ratio is None else f"x{ratio:.2f} vs {reference:.3g}"
+        print(f"{name:<60} {value:>12.3g} {unit:<12} {versus}")
+    for name, *_ in regressions:
+        print(f"REGRESSION {name}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
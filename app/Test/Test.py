@@ -9,14 +9,49 @@ from BE_Coffee_Shop import (
     Drink,
     Simulation,
     RabbitMQProducer,
+    EventEngine,
+    EventType,
+    PrepTime,
+    menu_registry,
+    AsyncSimulation,
+    AsyncQueueSource,
+    run_shops,
+    CustomerStore,
+    FastestSkillPolicy,
+    RoundRobinPolicy,
+    JsonlReplaySource,
+    MessageSource,
+    RabbitMQSource,
+    RandomStreams,
+    replicate,
+    spawn_seed,
+    _truncated_normal_ppf,
 )
+from metrics import Histogram, ShopMetrics
+from parallel_runner import ParallelRunner
+from staffing import StaffingOptimizer
+from event_log import EventSink
+from Benchmark.benchmark import compare
+from estimator import erlang_c, estimate, prep_moments, validate
+from trace_writer import TRACE_DTYPE, TraceWriter, epoch_ms, load_trace
+import BE_Coffee_Shop
 import unittest
+import tempfile
+import shutil
+import subprocess
+import sys
+import pstats
+import pickle
+import asyncio
+import numpy as np
 import logging
 from dependency_injector import containers, providers
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import pika
+import pika.exceptions
 import json
+import unittest.mock
 from unittest.mock import patch, MagicMock
 
 
@@ -52,6 +87,30 @@ class testBE(unittest.TestCase):
         self.assertEqual(barista.latte.mu, 5)
         self.assertEqual(barista.latte.std, 1)
 
+    def test_menu_registry(self):
+        with patch("builtins.open", wraps=open) as mocked_open:
+            baristas = [
+                self.container.barista_factory(csv_file=csv_path, level=Skill.expert)
+                for _ in range(50)
+            ]
+        self.assertLessEqual(mocked_open.call_count, 1)
+        self.assertIs(baristas[0].menu, baristas[-1].menu)
+        self.assertIs(baristas[0].latte, baristas[-1].latte)
+        self.assertEqual(baristas[0].drink_list, ("latte", "moca"))
+        self.assertAlmostEqual(baristas[0].moca.mu, 4.8)
+        self.assertAlmostEqual(baristas[0].menu.std[Skill.Amature.value - 1][1], 2.4)
+        self.assertIs(baristas[0].choose_drink(0.0), baristas[0].latte)
+        self.assertIs(baristas[0].choose_drink(0.999), baristas[0].moca)
+        with self.assertRaises(AttributeError):
+            baristas[0].espresso
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = shutil.copy(csv_path, directory)
+            menu = menu_registry.get(path)
+            self.assertIs(menu_registry.get(path), menu)
+            os.utime(path, ns=(menu.mtime + 1, menu.mtime + 1))
+            self.assertIsNot(menu_registry.get(path), menu)
+
     def test_customer(self):
         barista = self.container.barista_factory(
             csv_file=csv_path, level=Skill.midlevel
@@ -70,6 +129,39 @@ class testBE(unittest.TestCase):
         self.assertEqual(customer.character, Character.CASUAL_CARL)
         self.assertEqual(customer.order.mu, 5)
         self.assertEqual(customer.order.std, 1)
+        self.assertEqual(Character.from_index(1), Character.IMPULSIVE_IRENE)
+        self.assertEqual(Character.from_index(4), Character.CASUAL_CARL)
+        for index in (0, -1, 5):
+            with self.assertRaises(ValueError):
+                Character.from_index(index)
+
+    def test_customer_store(self):
+        store = CustomerStore(capacity=2)
+        customers = [
+            self.container.customer_factory(
+                position_in_row=i,
+                character=Character.SPEEDY_SAM,
+                arrival_time=self.default_time,
+            )
+            for i in range(5)
+        ]
+        ids = [store.insert(c) for c in customers[:3]]
+        self.assertEqual(ids, [0, 1, 2])
+        self.assertEqual(len(store), 3)
+        self.assertIs(store[1], customers[1])
+        self.assertIs(store.remove(1), customers[1])
+        self.assertNotIn(1, store)
+        with self.assertRaises(KeyError):
+            store[1]
+        self.assertEqual(store.insert(customers[3]), 1)
+        self.assertEqual(customers[3].id, 1)
+        self.assertEqual(store.insert(customers[4]), 3)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(
+            [c.position_in_row for c in store], [0, 3, 2, 4]
+        )
+        with self.assertRaises(AttributeError):
+            customers[0].nickname = "Carl"
 
     def test_order_line(self):
         waiting_line = self.container.waiting_line_factory()
@@ -91,6 +183,36 @@ class testBE(unittest.TestCase):
         waiting_line.enter_line(customer)
         self.assertEqual(waiting_line.count_customers(), 3)
 
+    def test_order_line_ends(self):
+        waiting_line = self.container.waiting_line_factory()
+        self.assertEqual(waiting_line.count_customers(), 0)
+        self.assertIsNone(waiting_line.quit_line())
+        self.assertEqual(repr(waiting_line), "reached the counter")
+        customers = [
+            self.container.customer_factory(
+                position_in_row=i,
+                character=Character.CASUAL_CARL,
+                arrival_time=self.default_time,
+            )
+            for i in range(5)
+        ]
+        waiting_line.enter_line(customers[0])
+        self.assertIs(waiting_line.quit_line(), customers[0])
+        self.assertEqual(len(waiting_line), 0)
+        self.assertIsNone(waiting_line.last)
+        for customer in customers:
+            waiting_line.enter_line(customer)
+        self.assertIs(waiting_line.peek(), customers[0])
+        self.assertIs(waiting_line.remove(customers[2]), customers[2])
+        self.assertEqual(
+            [c.position_in_row for c in waiting_line], [4, 3, 1, 0]
+        )
+        self.assertIs(waiting_line.quit_line(), customers[0])
+        self.assertIs(waiting_line.remove(customers[4]), customers[4])
+        self.assertEqual([c.position_in_row for c in waiting_line], [3, 1])
+        self.assertEqual(len(waiting_line), 2)
+        self.assertIs(waiting_line.peek(), customers[1])
+
     def test_rush_hour(self):
         barista = self.container.barista_factory(
             csv_file=csv_path, level=Skill.midlevel
@@ -107,7 +229,13 @@ class testBE(unittest.TestCase):
         rush_hour.add_barista(barista=barista)
         self.assertEqual(rush_hour.barista_list[0].level, Skill.midlevel)
 
+        save_path = os.path.join(os.getcwd(), "my_logger.out")
         logger = logging.getLogger("CoffeeShopLogger")
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+        if os.path.exists(save_path):
+            os.remove(save_path)
         logger.setLevel(logging.INFO)
         file_handler = logging.FileHandler(save_path)
         file_handler.setLevel(logging.INFO)
@@ -134,17 +262,279 @@ class testBE(unittest.TestCase):
             rush_hour.drink_wait_list[0].order_time, datetime(2024, 10, 10, 12, 10, 50)
         )
         self.assertIsInstance(rush_hour.drink_wait_list[0].order, Drink)
-        save_path = os.path.join(os.getcwd(), "my_logger.out")
-        if os.path.exists(save_path):
-            os.remove(save_path)
         rush_hour.serve_drink_wait_list(
             time=datetime(2024, 10, 10, 12, 25, 50), logger=logger
         )
+        file_handler.flush()
         self.assertTrue(os.path.exists(save_path))
+        logger.removeHandler(file_handler)
+        file_handler.close()
+
+    def test_dispatch_policies(self):
+        logger = logging.getLogger("CoffeeShopLogger")
+        start = datetime(2024, 10, 10, 12, 10)
+        levels = [Skill.Amature, Skill.expert, Skill.midlevel]
+        expected = {
+            None: [Skill.Amature, Skill.expert],
+            FastestSkillPolicy: [Skill.expert, Skill.midlevel],
+            RoundRobinPolicy: [Skill.Amature, Skill.expert],
+        }
+        for policy, first_two in expected.items():
+            waiting_line = self.container.waiting_line_factory()
+            rush_hour = self.container.rush_hour_factory(
+                order_list=waiting_line, policy=policy() if policy else None
+            )
+            for level in levels:
+                rush_hour.add_barista(
+                    self.container.barista_factory(csv_file=csv_path, level=level)
+                )
+            rush_hour.find_barista_and_order(time=start, logger=logger)
+            self.assertEqual(len(rush_hour.idle_baristas), 3)
+            for i, character in enumerate([Character.IMPULSIVE_IRENE, Character.CASUAL_CARL]):
+                waiting_line.enter_line(
+                    self.container.customer_factory(
+                        position_in_row=i, character=character, arrival_time=start
+                    )
+                )
+            rush_hour.find_barista_and_order(time=start, logger=logger)
+            busy = [b.level for b in rush_hour.barista_list if b.customer is not None]
+            self.assertEqual(sorted(busy, key=levels.index), sorted(first_two, key=levels.index))
+            self.assertEqual(len(rush_hour.decisions), 2)
+            rush_hour.find_barista_and_order(time=start + timedelta(seconds=10), logger=logger)
+            self.assertEqual(len(rush_hour.decisions), 1)
+            self.assertEqual(len(rush_hour.drink_wait_list), 1)
+            self.assertEqual(len(rush_hour.idle_baristas), 2)
+
+        rush_hour = self.container.rush_hour_factory(
+            order_list=self.container.waiting_line_factory(), policy=RoundRobinPolicy()
+        )
+        for level in levels:
+            rush_hour.add_barista(self.container.barista_factory(csv_file=csv_path, level=level))
+        served_by = []
+        for i in range(4):
+            rush_hour.order_list.enter_line(
+                self.container.customer_factory(
+                    position_in_row=i, character=Character.IMPULSIVE_IRENE, arrival_time=start
+                )
+            )
+            now = start + timedelta(minutes=i)
+            rush_hour.find_barista_and_order(time=now, logger=logger)
+            served_by.append(rush_hour.decisions[0][2].level)
+            rush_hour.find_barista_and_order(time=now + timedelta(seconds=10), logger=logger)
+        self.assertEqual(served_by, levels + [Skill.Amature])
+
+    def test_serve_all_ready_drinks(self):
+        logger = logging.getLogger("CoffeeShopLogger")
+        start = datetime(2024, 10, 10, 12, 10)
+        waiting_line = self.container.waiting_line_factory()
+        rush_hour = self.container.rush_hour_factory(order_list=waiting_line)
+        rush_hour.metrics = ShopMetrics()
+        for _ in range(3):
+            rush_hour.add_barista(
+                self.container.barista_factory(csv_file=csv_path, level=Skill.midlevel)
+            )
+        for i in range(3):
+            rush_hour.add_customer(
+                self.container.customer_factory(
+                    position_in_row=i,
+                    character=Character.IMPULSIVE_IRENE,
+                    arrival_time=start,
+                ),
+                start,
+            )
+        rush_hour.find_barista_and_order(time=start, logger=logger)
+        self.assertEqual(rush_hour.metrics.snapshot()["in_line"], 0)
+        with patch("BE_Coffee_Shop.norm_cdf", side_effect=lambda minutes, loc, scale: float(minutes >= 2)):
+            rush_hour.find_barista_and_order(time=start + timedelta(seconds=10), logger=logger)
+        ready = sorted(c.ready_time for c in rush_hour.drink_wait_list)
+        self.assertEqual(rush_hour.drink_wait_list[0].ready_time, ready[0])
+        served = rush_hour.serve_drink_wait_list(time=ready[-1], logger=logger)
+        self.assertEqual(sorted(served), [0, 1, 2])
+        self.assertEqual(len(rush_hour.drink_wait_list), 0)
+        self.assertEqual(
+            rush_hour.metrics.snapshot()["events"],
+            {"arrival": 3, "counter": 3, "order": 3, "served": 3},
+        )
+
+    def test_sampled_prep_time(self):
+        barista = self.container.barista_factory(
+            csv_file=csv_path, level=Skill.midlevel
+        )
+        uniforms = np.random.default_rng(3).random(2000)
+        samples = [barista.latte.prep_minutes(u) for u in uniforms]
+        self.assertGreaterEqual(min(samples), 0)
+        self.assertAlmostEqual(sum(samples) / len(samples), 5, delta=0.2)
+        uniforms = np.append(uniforms, [0.0, 1e-300, np.nextafter(1.0, 0.0)])
+        for mu, std in ((5, 1), (0.5, 2), (40, 1), (3, 0)):
+            drink = Drink("drink", mu, std)
+            np.testing.assert_allclose(
+                [drink.prep_minutes(u) for u in uniforms],
+                _truncated_normal_ppf(mu, std, uniforms),
+                atol=1e-9,
+            )
+
+        waiting_line = self.container.waiting_line_factory()
+        customer = self.container.customer_factory(
+            position_in_row=7,
+            character=Character.IMPULSIVE_IRENE,
+            arrival_time=self.default_time,
+        )
+        waiting_line.enter_line(customer)
+        rush_hour = self.container.rush_hour_factory(
+            order_list=waiting_line, prep_time=PrepTime.sampled
+        )
+        rush_hour.add_barista(barista=barista)
+        logger = logging.getLogger("CoffeeShopLogger")
+        start = datetime(2024, 10, 10, 12, 10)
+        rush_hour.find_barista_and_order(time=start, logger=logger)
+        rush_hour.find_barista_and_order(time=start + timedelta(seconds=10), logger=logger)
+        self.assertEqual(len(rush_hour.drink_wait_list), 1)
+        with patch("BE_Coffee_Shop.norm_cdf") as mocked_cdf:
+            before = rush_hour.serve_drink_wait_list(
+                time=customer.ready_time - timedelta(seconds=1), logger=logger
+            )
+            after = rush_hour.serve_drink_wait_list(time=customer.ready_time, logger=logger)
+        mocked_cdf.assert_not_called()
+        self.assertEqual(before, [])
+        self.assertEqual(after, [7])
+        self.assertEqual(len(rush_hour.drink_wait_list), 0)
+
+    def test_run_replications(self):
+        simulation = Simulation(menu_path=csv_path, prep_time=PrepTime.sampled)
+        arrivals = [(0, Character.IMPULSIVE_IRENE)] * 3 + [(5, Character.CASUAL_CARL)]
+        result = simulation.run_replications(
+            2000, arrivals, [Skill.midlevel, Skill.expert], seed=1
+        )
+        self.assertEqual(result["queue_time"].shape, (2000, 4))
+        self.assertTrue(
+            np.allclose(result["queue_time"][0], [0, 0, 10 / 60, 0])
+        )
+        self.assertTrue(np.allclose(result["ordering_time"][0], [1 / 6] * 3 + [0.75]))
+        self.assertTrue((result["barista"] == [0, 1, 0, 0]).all())
+        self.assertGreaterEqual(result["prep_time"].min(), 0)
+        latte = result["prep_time"][(result["drink"] == 0) & (result["barista"] == 0)]
+        self.assertAlmostEqual(latte.mean(), 5, delta=0.1)
+        again = simulation.run_replications(
+            2000, arrivals, [Skill.midlevel, Skill.expert], seed=1
+        )
+        self.assertTrue(np.array_equal(result["prep_time"], again["prep_time"]))
+
+        # same queue and ordering times as the object based event engine
+        engine = EventEngine(self.default_time)
+        rush_hour = self.container.rush_hour_factory(
+            order_list=self.container.waiting_line_factory(),
+            prep_time=PrepTime.sampled,
+        )
+        rush_hour.attach(engine, logging.getLogger("CoffeeShopLogger"))
+        for level in (Skill.midlevel, Skill.expert):
+            rush_hour.add_barista(
+                self.container.barista_factory(csv_file=csv_path, level=level)
+            )
+        customers = []
+        for i, (minute, character) in enumerate(arrivals):
+            at = self.default_time + timedelta(minutes=minute)
+            customers.append(
+                self.container.customer_factory(
+                    position_in_row=i, character=character, arrival_time=at
+                )
+            )
+            engine.schedule(at, EventType.arrival, customers[-1])
+        engine.run()
+        for i, customer in enumerate(customers):
+            queued = (customer.order_start_time - customer.arrival_time).total_seconds()
+            ordering = (customer.order_time - customer.order_start_time).total_seconds()
+            self.assertAlmostEqual(queued / 60, result["queue_time"][0, i])
+            self.assertAlmostEqual(ordering / 60, result["ordering_time"][0, i])
+
+    def test_parallel_runner(self):
+        scenarios = list(
+            ParallelRunner.grid(
+                [csv_path],
+                [[Skill.Amature], [Skill.expert, Skill.expert]],
+                [[(0, Character.SPEEDY_SAM)] * 4],
+                seeds=[0, 1],
+                replications=200,
+            )
+        )
+        self.assertEqual(len(scenarios), 4)
+        serial = {repr(s): s.run() for s in scenarios}
+        results = list(ParallelRunner(max_workers=2).run(scenarios))
+        self.assertEqual(len(results), 4)
+        for scenario, summary in results:
+            self.assertEqual(summary, serial[repr(scenario)])
+            self.assertEqual(summary["customers"], 800)
+        self.assertNotEqual(
+            serial[repr(scenarios[0])]["prep_time"], serial[repr(scenarios[1])]["prep_time"]
+        )
+
+    def test_event_engine(self):
+        engine = EventEngine(self.default_time)
+        seen = []
+        engine.register(EventType.arrival, lambda at, payload: seen.append(payload))
+        engine.schedule(datetime(2024, 9, 14, 0, 5), EventType.arrival, "second")
+        engine.schedule(datetime(2024, 9, 14, 0, 1), EventType.arrival, "first")
+        engine.schedule(datetime(2024, 9, 14, 0, 5), EventType.arrival, "third")
+        engine.run(until=datetime(2024, 9, 14, 0, 2))
+        self.assertEqual(seen, ["first"])
+        self.assertEqual(engine.time, datetime(2024, 9, 14, 0, 2))
+        engine.schedule(datetime(2024, 9, 14, 0, 6), EventType.close_shop)
+        engine.schedule(datetime(2024, 9, 14, 0, 7), EventType.arrival, "late")
+        engine.run()
+        self.assertEqual(seen, ["first", "second", "third"])
+        self.assertTrue(engine.closed)
+        self.assertEqual(engine.time, datetime(2024, 9, 14, 0, 6))
+
+    def test_rush_hour_events(self):
+        engine = EventEngine(self.default_time)
+        waiting_line = self.container.waiting_line_factory()
+        rush_hour = self.container.rush_hour_factory(order_list=waiting_line)
+        rush_hour.attach(engine, logging.getLogger("CoffeeShopLogger"))
+        rush_hour.add_barista(
+            self.container.barista_factory(csv_file=csv_path, level=Skill.expert)
+        )
+        customers = []
+        for i in range(3):
+            customer = self.container.customer_factory(
+                position_in_row=i,
+                character=Character.IMPULSIVE_IRENE,
+                arrival_time=self.default_time,
+            )
+            customers.append(customer)
+            engine.schedule(self.default_time, EventType.arrival, customer)
+        with patch("time.sleep") as mocked_sleep:
+            engine.run()
+        mocked_sleep.assert_not_called()
+        self.assertEqual(sorted(c.position_in_row for c in rush_hour.served), [0, 1, 2])
+        self.assertEqual(len(rush_hour.drink_wait_list), 0)
+        self.assertIsNone(waiting_line.last)
+        for i, customer in enumerate(customers):
+            self.assertEqual(
+                customer.order_start_time - self.default_time, timedelta(seconds=10 * i)
+            )
+            self.assertEqual(
+                customer.order_time - customer.order_start_time, timedelta(seconds=10)
+            )
+
+    def test_simulate(self):
+        simulation = Simulation(menu_path=csv_path)
+        message = {
+            "barista": {"count": 1, "employees": [{"level_index": 2}]},
+            "customer": {"count": 2, "people": [{"character_index": 1}, {"character_index": 3}]},
+            "close the store": "false",
+        }
+        start = simulation.time
+        rush_hour = simulation.simulate([(start, message)])
+        self.assertEqual(rush_hour.served, [])
+        self.assertEqual(simulation.customer_number, 2)
+        self.assertEqual(len(simulation.customers), 0)
+        self.assertFalse(hasattr(BE_Coffee_Shop, "customer0"))
+        self.assertEqual(len(rush_hour.drink_wait_list), 0)
+        self.assertEqual(rush_hour.barista_list[0].level, Skill.midlevel)
 
     @patch("pika.BlockingConnection")
     def test_rabitmq_send(self, mock_blocking_connection):
         mock_connection = MagicMock()
+        mock_connection.is_closed = False
         mock_channel = MagicMock()
         mock_blocking_connection.return_value = mock_connection
         mock_connection.channel.return_value = mock_channel
@@ -152,6 +542,8 @@ class testBE(unittest.TestCase):
         producer = RabbitMQProducer(queue_name="test_queue")
         message_dict = {"barista": 2, "customer": 5}
         producer.send_message(message_dict)
+        mock_connection.close.assert_not_called()
+        producer.close()
 
         mock_blocking_connection.assert_called_once_with(
             pika.ConnectionParameters("localhost")
@@ -168,6 +560,36 @@ class testBE(unittest.TestCase):
         )
         mock_connection.close.assert_called_once()
 
+    @patch("pika.BlockingConnection")
+    def test_rabbitmq_send_many(self, mock_blocking_connection):
+        mock_connection = MagicMock()
+        mock_connection.is_closed = False
+        mock_channel = MagicMock()
+        mock_blocking_connection.return_value = mock_connection
+        mock_connection.channel.return_value = mock_channel
+        published = []
+
+        def publish(**kwargs):
+            if len(published) == 3 and mock_blocking_connection.call_count == 1:
+                raise pika.exceptions.StreamLostError("connection lost")
+            published.append(json.loads(kwargs["body"]))
+
+        mock_channel.basic_publish.side_effect = publish
+        messages = [{"customer": {"count": 1, "people": [{"character_index": i}]}} for i in range(5)]
+        with RabbitMQProducer(queue_name="test_queue", confirm=True) as producer:
+            self.assertEqual(producer.send_many(messages), 5)
+            self.assertEqual(producer.send_many(messages[:2]), 2)
+        self.assertEqual(published, messages + messages[:2])
+        self.assertEqual(mock_blocking_connection.call_count, 2)
+        self.assertEqual(mock_channel.queue_declare.call_count, 2)
+        self.assertEqual(mock_channel.confirm_delivery.call_count, 2)
+
+        mock_channel.basic_publish.side_effect = pika.exceptions.StreamLostError("down")
+        producer = RabbitMQProducer(queue_name="test_queue", retries=1)
+        with self.assertRaises(pika.exceptions.StreamLostError):
+            producer.send_message(messages[0])
+        self.assertIsNone(producer.channel)
+
     @patch("pika.BlockingConnection")
     def test_start_consuming(self, mock_blocking_connection):
         mock_connection = MagicMock()
@@ -200,6 +622,540 @@ class testBE(unittest.TestCase):
         mock_channel.basic_get.assert_called_with(queue="run_simulation", auto_ack=True)
         mocked_print.assert_called_with({"barista": 2, "customer": 5})
 
+    @patch("pika.BlockingConnection")
+    def test_open_shop_prefetch(self, mock_blocking_connection):
+        mock_connection = MagicMock()
+        mock_connection.is_closed = False
+        mock_channel = MagicMock()
+        mock_blocking_connection.return_value = mock_connection
+        mock_connection.channel.return_value = mock_channel
+        simulation = Simulation(menu_path=csv_path)
+        messages = [
+            [
+                {"barista": {"count": 1, "employees": [{"level_index": 3}]}},
+                {"customer": {"count": 2, "people": [{"character_index": 2}] * 2}},
+            ],
+            [],
+            [{"close the store": "true"}],
+        ]
+        waits = []
+
+        def process_data_events(time_limit):
+            waits.append(time_limit)
+            callback = mock_channel.basic_consume.call_args.kwargs["on_message_callback"]
+            for message in messages.pop(0) if messages else []:
+                tag = len(simulation.deliveries) + 10 * len(waits)
+                method = MagicMock(delivery_tag=tag)
+                callback(mock_channel, method, None, json.dumps(message).encode())
+
+        mock_connection.process_data_events.side_effect = process_data_events
+        start = simulation.time
+        simulation.open_shop(time_step=0, prefetch_count=50)
+
+        mock_channel.basic_qos.assert_called_once_with(prefetch_count=50)
+        mock_channel.basic_get.assert_not_called()
+        self.assertEqual(
+            mock_channel.basic_ack.call_args_list,
+            [
+                unittest.mock.call(delivery_tag=11, multiple=True),
+                unittest.mock.call(delivery_tag=30, multiple=True),
+            ],
+        )
+        self.assertEqual(waits, [None, 0, 0])
+        self.assertEqual(simulation.customer_number, 2)
+        self.assertEqual(simulation.time, start + timedelta(minutes=2))
+        mock_connection.close.assert_called_once()
+
+    def test_async_shops(self):
+        logger = logging.getLogger("CoffeeShopLogger.async_test")
+        logger.propagate = False
+        shops = [
+            AsyncSimulation(
+                menu_path=csv_path,
+                source=AsyncQueueSource(),
+                queue_name=f"shop{i}",
+                prep_time=PrepTime.sampled,
+                logger=logger,
+                instrument=i == 0,
+            )
+            for i in range(100)
+        ]
+
+        async def feed_and_run():
+            for i, shop in enumerate(shops):
+                shop.source.queue.put_nowait(
+                    {"barista": {"count": 1, "employees": [{"level_index": 1 + i % 3}]}}
+                )
+                shop.source.queue.put_nowait(
+                    {"customer": {"count": 3, "people": [{"character_index": 1 + i % 4}] * 3}}
+                )
+            running = asyncio.ensure_future(run_shops(shops))
+            await asyncio.sleep(0.01)
+            self.assertFalse(running.done())
+            for shop in shops:
+                shop.source.queue.put_nowait({"close the store": "true"})
+            return await running
+
+        results = asyncio.run(feed_and_run())
+        self.assertEqual(len(results), 100)
+        for shop, rush_hour in zip(shops, results):
+            self.assertEqual(shop.customer_number, 3)
+            self.assertEqual(len(rush_hour.barista_list), 1)
+        self.assertGreater(shops[0].stats()["phases"]["apply"]["calls"], 0)
+        self.assertGreater(shops[0].stats()["gauges"]["queue_length"]["count"], 0)
+        self.assertIsNone(shops[1].instruments)
+
+    def test_metrics(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+        self.assertAlmostEqual(histogram.quantile(0.5), 500, delta=5)
+        self.assertAlmostEqual(histogram.quantile(0.99), 990, delta=10)
+
+        snapshots = []
+        for seed in range(2):
+            simulation = Simulation(menu_path=csv_path, prep_time=PrepTime.sampled, seed=seed)
+            start = simulation.time
+            simulation.simulate(
+                [
+                    (
+                        start,
+                        {
+                            "barista": {"count": 2, "employees": [{"level_index": 1}, {"level_index": 3}]},
+                            "customer": {"count": 4, "people": [{"character_index": 1}, {"character_index": 2}] * 2},
+                        },
+                    ),
+                    (start + timedelta(minutes=3), {"customer": {"count": 1, "people": [{"character_index": 4}]}}),
+                ]
+            )
+            snapshots.append(simulation.metrics)
+        snapshot = snapshots[0].snapshot()
+        self.assertEqual(snapshot["events"], {"arrival": 5, "counter": 5, "order": 5, "served": 5})
+        self.assertEqual(snapshot["in_line"], 0)
+        self.assertEqual(snapshot["queue_time"]["all"]["count"], 5)
+        self.assertEqual(snapshot["queue_time"]["all"]["min"], 0)
+        self.assertEqual(snapshot["ordering_time"]["character"]["CASUAL_CARL"]["mean"], 45)
+        self.assertEqual(
+            sum(s["count"] for s in snapshot["prep_time"]["skill"].values()), 5
+        )
+        self.assertLessEqual(
+            set(snapshot["prep_time"]["drink"]), {"latte", "moca"}
+        )
+        merged = ShopMetrics()
+        for metrics in snapshots:
+            merged.merge(pickle.loads(pickle.dumps(metrics)))
+        merged_snapshot = merged.snapshot()
+        self.assertEqual(merged_snapshot["total_time"]["all"]["count"], 10)
+        self.assertEqual(
+            merged_snapshot["total_time"]["all"]["max"],
+            max(m.snapshot()["total_time"]["all"]["max"] for m in snapshots),
+        )
+
+    def test_event_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "events.jsonl")
+            simulation = Simulation(
+                menu_path=csv_path,
+                prep_time=PrepTime.sampled,
+                event_log=path,
+                event_log_level=logging.DEBUG,
+            )
+            simulation.logger.setLevel(logging.WARNING)
+            start = simulation.time
+            with patch.object(logging.Logger, "_log") as mocked_log:
+                simulation.simulate(
+                    [
+                        (
+                            start,
+                            {
+                                "barista": {"count": 1, "employees": [{"level_index": 2}]},
+                                "customer": {"count": 3, "people": [{"character_index": 2}] * 3},
+                            },
+                        ),
+                        (start + timedelta(minutes=30), {"close the store": "true"}),
+                    ]
+                )
+            mocked_log.assert_not_called()
+            with open(path) as file:
+                events = [json.loads(line) for line in file]
+            self.assertEqual(
+                [e["event"] for e in events if e["customer"] == 2],
+                ["arrival", "counter", "order", "served"],
+            )
+            self.assertEqual(len(events), 12)
+            self.assertEqual(events[0]["time"], start.isoformat())
+
+            with EventSink(path, level=logging.INFO, batch_size=2) as sink:
+                self.assertFalse(sink.enabled(logging.DEBUG))
+                sink.emit(logging.DEBUG, "arrival", start, 1)
+                self.assertEqual(sink.buffer, [])
+                for i in range(5):
+                    sink.emit(logging.INFO, "served", start, i, "latte")
+                sink.flush()
+                self.assertEqual(sink.written, 5)
+                with open(path) as file:
+                    self.assertEqual(len(file.readlines()), 5)
+            self.assertEqual(sink.written, 5)
+
+    def test_trace_writer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            simulation = Simulation(
+                menu_path=csv_path, prep_time=PrepTime.sampled, trace=directory
+            )
+            simulation.trace.chunk_size = 4
+            simulation.trace.chunk = np.empty(4, dtype=TRACE_DTYPE)
+            start = simulation.time
+            simulation.simulate(
+                [
+                    (
+                        start,
+                        {
+                            "barista": {"count": 2, "employees": [{"level_index": 1}, {"level_index": 3}]},
+                            "customer": {"count": 6, "people": [{"character_index": 4}] * 6},
+                        },
+                    ),
+                ]
+            )
+            meta, chunks = load_trace(directory)
+            self.assertEqual(meta["chunks"], 2)
+            self.assertIsInstance(chunks[0], np.memmap)
+            trace = np.concatenate(chunks)
+            self.assertEqual(sorted(trace["customer"]), list(range(6)))
+            self.assertTrue((trace["arrival_time"] == epoch_ms(start)).all())
+            self.assertTrue(
+                (trace["order_time"] - trace["order_start_time"] == 45_000).all()
+            )
+            self.assertTrue((trace["served_time"] >= trace["order_time"]).all())
+            self.assertEqual(meta["characters"], {"4": "CASUAL_CARL"})
+            self.assertTrue(set(meta["drinks"]) <= {"latte", "moca"})
+            self.assertEqual(set(trace["skill"]), {Skill.Amature.value, Skill.expert.value})
+            self.assertEqual(set(trace["barista"]), {0, 1})
+            del chunks, trace
+
+    def test_snapshot_resume(self):
+        start = datetime(2024, 10, 10, 8, 0)
+        messages = [
+            (
+                start,
+                {"barista": {"count": 2, "employees": [{"level_index": 1}, {"level_index": 3}]}},
+            )
+        ] + [
+            (
+                start + timedelta(minutes=minute),
+                {"customer": {"count": 3, "people": [{"character_index": 2}] * 3}},
+            )
+            for minute in range(0, 180, 3)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "shop.snapshot")
+            trace = os.path.join(directory, "trace")
+            event_log = os.path.join(directory, "events.jsonl")
+            original = Simulation(
+                menu_path=csv_path,
+                prep_time=PrepTime.sampled,
+                seed=16,
+                snapshot_path=path,
+                snapshot_every=timedelta(minutes=60),
+                trace=trace,
+                event_log=event_log,
+            )
+            original.simulate(messages)
+            snapshot_time = original._last_snapshot_time
+            self.assertEqual(snapshot_time, start + timedelta(minutes=120))
+            original.close_shop()
+            self.assertEqual(
+                sorted(os.listdir(directory)), ["events.jsonl", "shop.snapshot", "trace"]
+            )
+            original_trace = np.concatenate(load_trace(trace, mmap_mode=None)[1])
+            with open(event_log) as file:
+                logged = len(file.readlines())
+
+            resumed = Simulation.resume(path, trace=trace, event_log=event_log)
+            self.assertEqual(resumed.time, snapshot_time)
+            self.assertGreater(len(resumed.customers), 0)
+            resumed.simulate([(at, m) for at, m in messages if at >= snapshot_time])
+            resumed.close_shop()
+            resumed_trace = np.concatenate(load_trace(trace, mmap_mode=None)[1])
+            with open(event_log) as file:
+                self.assertGreater(len(file.readlines()), logged)
+
+            # a replayed capture skips what the snapshot already holds
+            capture = os.path.join(directory, "capture.jsonl")
+            JsonlReplaySource.write(capture, messages, seed=99)
+            replayed = Simulation.resume(path)
+            replayed.replay(JsonlReplaySource(capture))
+            replayed.close_shop()
+            self.assertEqual(replayed.customer_number, original.customer_number)
+            self.assertEqual(replayed.metrics.snapshot(), original.metrics.snapshot())
+
+        self.assertTrue(np.array_equal(resumed_trace, original_trace))
+
+        self.assertEqual(resumed.customer_number, original.customer_number)
+        self.assertEqual(len(resumed.customers), 0)
+        self.assertEqual(resumed.metrics.snapshot(), original.metrics.snapshot())
+
+    def test_jsonl_replay(self):
+        start = datetime(2024, 10, 10, 8, 0)
+        hire = {"barista": {"count": 2, "employees": [{"level_index": 1}, {"level_index": 2}]}}
+        arrive = {"customer": {"count": 4, "people": [{"character_index": 3}] * 4}}
+        timed = [(start, hire)] + [
+            (start + timedelta(minutes=minute), arrive) for minute in range(0, 60, 5)
+        ] + [(start + timedelta(minutes=90), {"close the store": "true"})]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.jsonl")
+            JsonlReplaySource.write(path, timed, seed=17)
+            runs = []
+            for _ in range(2):
+                simulation = Simulation(
+                    menu_path=csv_path,
+                    prep_time=PrepTime.sampled,
+                    trace=os.path.join(directory, f"trace{len(runs)}"),
+                    seed=len(runs),
+                )
+                source = JsonlReplaySource(path)
+                simulation.replay(source)
+                simulation.close_shop()
+                self.assertEqual(source.seed, 17)
+                self.assertEqual(simulation.customer_number, 48)
+                meta, chunks = load_trace(simulation.trace.directory, mmap_mode=None)
+                runs.append(np.concatenate(chunks))
+            self.assertTrue(np.array_equal(runs[0], runs[1]))
+
+            # bare messages are one simulated minute apart, nothing after closing
+            with open(path, "w") as file:
+                for message_dict in (hire, arrive, {"close the store": "true"}, arrive):
+                    file.write(json.dumps(message_dict) + "\n")
+            source = JsonlReplaySource(path)
+            source.open()
+            self.assertIsNone(source.seed)
+            self.assertEqual(
+                [at for at, _ in source.messages(start)],
+                [start, start + timedelta(minutes=1), start + timedelta(minutes=2)],
+            )
+            source.close()
+
+        class NoMessages(MessageSource):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoMessages()
+
+    @patch("pika.BlockingConnection")
+    def test_rabbitmq_source(self, mock_blocking_connection):
+        mock_connection = MagicMock()
+        mock_channel = MagicMock()
+        mock_blocking_connection.return_value = mock_connection
+        mock_connection.channel.return_value = mock_channel
+        mock_connection.is_closed = False
+        frame = MagicMock()
+        mock_channel.basic_get.side_effect = [
+            (frame, None, json.dumps({"barista": {"count": 1, "employees": [{"level_index": 3}]}}).encode()),
+            (None, None, None),
+            (frame, None, json.dumps({"customer": {"count": 1, "people": [{"character_index": 1}]}}).encode()),
+            (frame, None, json.dumps({"close the store": "true"}).encode()),
+        ]
+        simulation = Simulation(menu_path=csv_path)
+        start = simulation.time
+        simulation.replay(RabbitMQSource(idle_wait=0))
+        mock_channel.queue_declare.assert_called_once_with(
+            queue="run_simulation", durable=True
+        )
+        mock_connection.process_data_events.assert_called_once_with(time_limit=0)
+        self.assertEqual(mock_channel.basic_get.call_count, 4)
+        self.assertEqual(simulation.customers[0].arrival_time, start + timedelta(minutes=2))
+        self.assertTrue(simulation.engine.closed)
+        mock_connection.close.assert_called_once()
+
+    def test_random_streams(self):
+        streams = RandomStreams(18, batch_size=8)
+        values = [streams.drinks.at(k) for k in (9, 2, 30, 3)]
+        first = streams.drinks.take(31)
+        self.assertEqual(values, [first[9], first[2], first[30], first[3]])
+        self.assertFalse(np.array_equal(first, streams.prep_time.take(31)))
+        arrivals = RandomStreams(18).poisson_arrivals(2.0, 600)
+        self.assertTrue((np.diff(arrivals) >= 0).all() and arrivals[-1] < 600)
+        self.assertAlmostEqual(len(arrivals) / 1200, 1, delta=0.1)
+
+        # a slow decider before fast ones, so orders are taken out of arrival order
+        arrivals = [(0, Character.IMPULSIVE_IRENE)] + [(0, Character.SPEEDY_SAM)] * 3
+        arrivals += [(4, Character.CASUAL_CARL)] * 2
+        baristas = [Skill.Amature, Skill.expert]
+        result = replicate(csv_path, 6, arrivals, baristas, seed=7)
+        head = replicate(csv_path, 2, arrivals, baristas, seed=7)
+        tail = replicate(csv_path, 4, arrivals, baristas, seed=7, first=2)
+        for key in result:
+            self.assertTrue(
+                np.array_equal(result[key], np.concatenate([head[key], tail[key]]))
+            )
+
+        start = datetime(2024, 10, 10, 8, 0)
+        hire = {"count": 2, "employees": [{"level_index": b.value} for b in baristas]}
+        for r in range(6):
+            simulation = Simulation(
+                menu_path=csv_path, prep_time=PrepTime.sampled, seed=spawn_seed(7, r)
+            )
+            timed = [(start, {"barista": hire})] + [
+                (
+                    start + timedelta(minutes=minute),
+                    {"customer": {"count": 1, "people": [{"character_index": list(Character).index(c) + 1}]}},
+                )
+                for minute, c in arrivals
+            ]
+            with tempfile.TemporaryDirectory() as directory:
+                simulation.trace = TraceWriter(directory)
+                simulation.simulate(timed)
+                simulation.close_shop()
+                meta, chunks = load_trace(directory, mmap_mode=None)
+            trace = np.sort(np.concatenate(chunks), order="customer")
+            drinks = [("latte", "moca").index(name) for name in meta["drinks"]]
+            self.assertEqual(
+                [drinks[code] for code in trace["drink"]], result["drink"][r].tolist()
+            )
+            self.assertTrue(
+                np.allclose(
+                    (trace["served_time"] - trace["order_time"]) / 60_000,
+                    result["prep_time"][r],
+                    atol=1e-4,
+                )
+            )
+
+    def test_staffing_optimizer(self):
+        arrivals = [(i * 0.25, Character.CASUAL_CARL) for i in range(60)]
+        optimizer = StaffingOptimizer(csv_path, arrivals, measure="total_time")
+        plan = optimizer.optimize(9.0)
+        self.assertEqual(plan["baristas"], {"Amature": 0, "midlevel": 2, "expert": 1})
+        self.assertEqual(plan["cost"], 5.0)
+        self.assertLessEqual(plan["total_time"], 9.0)
+        for mix in optimizer.cache:
+            if optimizer.cost(mix) < plan["cost"]:
+                self.assertFalse(optimizer.meets(mix, 9.0)[0])
+
+        with patch("BE_Coffee_Shop.replicate", wraps=BE_Coffee_Shop.replicate) as mocked:
+            self.assertEqual(optimizer.optimize(9.0), plan)
+            mocked.assert_not_called()
+
+        # the line alone needs three baristas, skills do not matter for it
+        queue = StaffingOptimizer(csv_path, arrivals, max_baristas=2)
+        self.assertIsNone(queue.optimize(1.0))
+        queue.max_baristas = 6
+        self.assertEqual(queue.optimize(1.0)["baristas"], {"Amature": 3, "midlevel": 0, "expert": 0})
+
+    def test_estimator(self):
+        self.assertAlmostEqual(erlang_c(1, 0.6), 0.6)
+        self.assertAlmostEqual(erlang_c(2, 1.0), 1 / 3)
+        # a single barista and one character is M/D/1, where Allen-Cunneen is exact
+        summary = estimate(csv_path, 1.0, {Character.CASUAL_CARL: 1}, [Skill.expert])
+        self.assertAlmostEqual(summary["utilization"], 0.75)
+        self.assertAlmostEqual(summary["queue_time"], 0.75 * 0.75 / (2 * 0.25))
+        mean, variance = prep_moments(csv_path, Skill.Amature)
+        uniforms = np.random.default_rng(5).random(20000)
+        barista = self.container.barista_factory(csv_file=csv_path, level=Skill.Amature)
+        samples = [barista.choose_drink(u).prep_minutes(v) for u, v in zip(uniforms, uniforms[::-1])]
+        self.assertAlmostEqual(np.mean(samples), mean, delta=0.05)
+        self.assertAlmostEqual(np.var(samples), variance, delta=0.1)
+        self.assertFalse(estimate(csv_path, 3.0, {Character.SPEEDY_SAM: 1}, [Skill.expert])["stable"])
+
+        mix = {Character.IMPULSIVE_IRENE: 1, Character.DELIBERATE_DAN: 2, Character.CASUAL_CARL: 1}
+        report = validate(
+            csv_path, [(5.0, mix, [Skill.midlevel] * 3)], samples=12, replications=2
+        )
+        self.assertEqual(len(report), 1)
+        self.assertAlmostEqual(report[0]["estimate"]["utilization"], 5 * (115 / 240) / 3)
+        self.assertTrue(report[0]["accurate"], report[0]["relative_error"])
+
+    def test_benchmark_compare(self):
+        baseline = {
+            "results": {
+                "line": {"value": 1.0, "unit": "s/customer"},
+                "shop": {"value": 100.0, "unit": "customers/s"},
+            }
+        }
+        results = {
+            "results": {
+                "line": {"value": 1.1, "unit": "s/customer"},
+                "shop": {"value": 50.0, "unit": "customers/s"},
+                "new": {"value": 3.0, "unit": "s/tick"},
+            }
+        }
+        rows, regressions = compare(results, baseline, threshold=1.25)
+        self.assertEqual(
+            rows, [("line", 1.1, 1.0, 1.1), ("shop", 50.0, 100.0, 2.0), ("new", 3.0, None, None)]
+        )
+        self.assertEqual([row[0] for row in regressions], ["shop"])
+        # a host twice as slow as for the baseline
+        baseline["meta"] = {"quick": False, "calibration": 1.0}
+        results["meta"] = {"quick": False, "calibration": 2.0}
+        rows, regressions = compare(results, baseline, threshold=1.25)
+        self.assertEqual([row[3] for row in rows], [0.55, 1.0, None])
+        self.assertEqual(regressions, [])
+        results["meta"] = {"quick": True}
+        with self.assertRaises(ValueError):
+            compare(results, baseline)
+
+    def test_instrumentation(self):
+        start = datetime(2024, 10, 10, 8, 0)
+        messages = [
+            (start, {"barista": {"count": 2, "employees": [{"level_index": 1}, {"level_index": 3}]}})
+        ] + [
+            (
+                start + timedelta(minutes=minute),
+                {"customer": {"count": 6, "people": [{"character_index": 4}] * 6}},
+            )
+            for minute in range(0, 10)
+        ]
+        plain = Simulation(menu_path=csv_path, prep_time=PrepTime.sampled, seed=22)
+        plain.simulate(messages)
+        self.assertEqual(plain.engine.handlers[EventType.arrival], plain.rush_hour.on_arrival)
+        stats = plain.stats()
+        self.assertEqual(stats["phases"], {})
+        self.assertEqual(stats["customers"], 0)
+        self.assertEqual(stats["gauges"]["drink_backlog"], {"current": 0})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "shop.pstats")
+            simulation = Simulation(
+                menu_path=csv_path,
+                prep_time=PrepTime.sampled,
+                seed=22,
+                instrument=True,
+                profile=path,
+                profile_window=(start + timedelta(minutes=3), start + timedelta(minutes=6)),
+            )
+            simulation.simulate(messages)
+            profile = pstats.Stats(path)
+        self.assertTrue(
+            any(function[2] == "on_arrival" for function in profile.stats)
+        )
+        self.assertEqual(simulation.metrics.snapshot(), plain.metrics.snapshot())
+        stats = simulation.stats()
+        phases = stats["phases"]
+        self.assertEqual(phases["apply"]["calls"], len(messages))
+        # the last read finds the stream exhausted
+        self.assertEqual(phases["intake"]["calls"], len(messages) + 1)
+        self.assertEqual(phases["drinks"]["calls"], 60)
+        self.assertEqual(phases["dispatch"]["calls"], 3 * 60)
+        self.assertGreater(phases["logging"]["calls"], 0)
+        self.assertEqual(phases["sleep"]["calls"], 0)
+        self.assertGreater(phases["dispatch"]["seconds"], 0)
+        gauges = stats["gauges"]
+        self.assertEqual(gauges["queue_length"]["count"], len(messages))
+        self.assertEqual(gauges["busy_baristas"]["max"], 2)
+        self.assertGreater(gauges["queue_length"]["max"], 0)
+        self.assertGreater(gauges["drink_backlog"]["max"], 0)
+        self.assertEqual(gauges["drink_backlog"]["current"], 0)
+
+    def test_lazy_imports(self):
+        script = (
+            "import sys, BE_Coffee_Shop; "
+            "print([m for m in ('scipy', 'pika', 'dependency_injector') if m in sys.modules])"
+        )
+        loaded = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        self.assertEqual(loaded, "[]")
+        self.assertTrue(hasattr(BE_Coffee_Shop.Container, "rush_hour_factory"))
+        self.assertAlmostEqual(BE_Coffee_Shop.norm_cdf(6.2, loc=5, scale=1), 0.8849303, places=6)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,163 @@
+import math
+
+import numpy as np
+
+from BE_Coffee_Shop import RandomStreams, menu_registry, replicate, spawn_seed
+
+
+def _normal_cdf(x):
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+def _normal_pdf(x):
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
+
+
+def prep_moments(menu_path, level):
+    """
+    Mean and variance in minutes of the prep time of a barista of `level`,
+    every drink of the menu equally likely and each N(mu, std) truncated at zero
+    """
+    means, second = [], []
+    for drink in menu_registry.get(menu_path).drinks[level]:
+        if drink.std <= 0:
+            mean = max(drink.mu, 0.0)
+            means.append(mean)
+            second.append(mean * mean)
+            continue
+        alpha = -drink.mu / drink.std
+        hazard = _normal_pdf(alpha) / (1 - _normal_cdf(alpha))
+        mean = drink.mu + drink.std * hazard
+        variance = drink.std**2 * (1 + alpha * hazard - hazard**2)
+        means.append(mean)
+        second.append(variance + mean * mean)
+    mean = sum(means) / len(means)
+    return mean, sum(second) / len(second) - mean * mean
+
+
+def ordering_moments(character_mix):
+    """
+    Mean and squared coefficient of variation of the time a customer holds a
+    barista (their decision delay), `character_mix` mapping Character to its
+    share of arrivals
+    """
+    total = sum(character_mix.values())
+    delays = [
+        (share / total, character.value[0] / 60)
+        for character, share in character_mix.items()
+    ]
+    mean = sum(p * d for p, d in delays)
+    second = sum(p * d * d for p, d in delays)
+    return mean, (second - mean * mean) / (mean * mean)
+
+
+def erlang_c(servers, load):
+    """
+    Probability an arrival waits in an M/M/c queue with `servers` servers and
+    offered `load` (arrival rate times mean service time, in servers)
+    """
+    if load >= servers:
+        return 1.0
+    term = 1.0
+    total = 1.0
+    for k in range(1, servers):
+        term *= load / k
+        total += term
+    last = term * load / servers / (1 - load / servers)
+    return last / (total + last)
+
+
+def estimate(menu_path, per_minute, character_mix, baristas, arrival_scv=1.0, quantile=0.95):
+    """
+    Steady-state M/G/c approximation of the shop, in minutes. Baristas are
+    the servers and are held for the decision delay only; drinks are made
+    in parallel, so prep time adds to the total but not to the line.
+    Waiting is Erlang-C scaled by the Allen-Cunneen factor
+    (arrival SCV + service SCV) / 2, exact for a single barista; the queue
+    quantile uses the exponential tail of M/M/c with the same scaling.
+    """
+    servers = len(baristas)
+    service, service_scv = ordering_moments(character_mix)
+    load = per_minute * service
+    utilization = load / servers
+    prep = [prep_moments(menu_path, level) for level in baristas]
+    prep_mean = sum(mean for mean, _ in prep) / servers
+    summary = {
+        "utilization": utilization,
+        "stable": utilization < 1,
+        "ordering_time": service,
+        "prep_time": prep_mean,
+    }
+    if utilization >= 1:
+        summary.update(p_wait=1.0, queue_time=math.inf, queue_time_quantile=math.inf)
+        summary["total_time"] = math.inf
+        return summary
+    p_wait = erlang_c(servers, load)
+    drain = servers / service - per_minute
+    factor = (arrival_scv + service_scv) / 2
+    summary["p_wait"] = p_wait
+    summary["queue_time"] = factor * p_wait / drain
+    summary["queue_time_quantile"] = (
+        factor * math.log(p_wait / (1 - quantile)) / drain if p_wait > 1 - quantile else 0.0
+    )
+    summary["total_time"] = summary["queue_time"] + service + prep_mean
+    return summary
+
+
+def validate(
+    menu_path,
+    scenarios,
+    minutes=480,
+    warmup=60,
+    samples=20,
+    replications=20,
+    seed=0,
+    tolerance=0.15,
+):
+    """
+    Compares `estimate` to `replicate` runs. Each scenario is a
+    (per_minute, character_mix, baristas) triple; `samples` Poisson arrival
+    streams of `minutes` are drawn and each replicated `replications` times,
+    ignoring customers who arrive in the first `warmup` minutes. Returns one
+    dict per scenario with both results, the relative error of the mean queue
+    and total times and whether both are within `tolerance`.
+    """
+    report = []
+    for index, (per_minute, character_mix, baristas) in enumerate(scenarios):
+        characters = list(character_mix)
+        weights = np.array([character_mix[c] for c in characters], dtype=float)
+        queue_times, total_times = [], []
+        for sample in range(samples):
+            scenario_seed = spawn_seed(spawn_seed(seed, index), sample)
+            times = RandomStreams(scenario_seed).poisson_arrivals(per_minute, minutes)
+            picks = np.random.default_rng(scenario_seed).choice(
+                len(characters), size=len(times), p=weights / weights.sum()
+            )
+            arrivals = [(t, characters[i]) for t, i in zip(times.tolist(), picks)]
+            result = replicate(menu_path, replications, arrivals, baristas, scenario_seed)
+            kept = times >= warmup
+            queue_times.append(result["queue_time"][:, kept])
+            total_times.append(
+                (result["queue_time"] + result["ordering_time"] + result["prep_time"])[:, kept]
+            )
+        simulated = {
+            "queue_time": float(np.concatenate(queue_times, axis=1).mean()),
+            "total_time": float(np.concatenate(total_times, axis=1).mean()),
+        }
+        estimated = estimate(menu_path, per_minute, character_mix, baristas)
+        error = {
+            key: abs(estimated[key] - value) / value if value else abs(estimated[key])
+            for key, value in simulated.items()
+        }
+        report.append(
+            {
+                "per_minute": per_minute,
+                "baristas": [level.name for level in baristas],
+                "characters": {c.name: character_mix[c] for c in characters},
+                "estimate": estimated,
+                "simulated": simulated,
+                "relative_error": error,
+                "accurate": all(e <= tolerance for e in error.values()),
+            }
+        )
+    return report
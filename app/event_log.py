@@ -0,0 +1,89 @@
+import json
+import logging
+import queue
+import threading
+
+
+class EventSink:
+    """
+    Structured log of simulation events written as JSON lines. `emit` only
+    appends a small tuple to a buffer; full buffers are handed to a writer
+    thread, which does all the formatting and file I/O. Events below `level`
+    return before building anything. `flush` and `close` wait until the file
+    on disk holds every event emitted so far. With `append` an existing log
+    is continued instead of replaced.
+    """
+
+    def __init__(self, path, level=logging.INFO, batch_size=4096, append=False):
+        self.path = path
+        self.level = level
+        self.batch_size = batch_size
+        self.buffer = []
+        self.written = 0
+        self._batches = queue.SimpleQueue()
+        self._file = open(path, "a" if append else "w")
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def enabled(self, level) -> bool:
+        return level >= self.level
+
+    def emit(self, level, event, time, customer=None, detail=None):
+        if level < self.level:
+            return
+        self.buffer.append((event, time, customer, detail))
+        if len(self.buffer) >= self.batch_size:
+            self._hand_off()
+
+    def _hand_off(self):
+        if self.buffer:
+            self._batches.put(self.buffer)
+            self.buffer = []
+
+    def flush(self):
+        """
+        Hands the buffer to the writer thread and waits until it has been
+        written and the file flushed
+        """
+        if self._file.closed:
+            return
+        self._hand_off()
+        done = threading.Event()
+        self._batches.put(done)
+        done.wait()
+
+    def _write(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, threading.Event):
+                self._file.flush()
+                batch.set()
+                continue
+            self._file.write(
+                "".join(
+                    f'{{"event": "{event}", "time": "{time.isoformat()}", '
+                    f'"customer": {json.dumps(customer)}, "detail": {json.dumps(detail)}}}\n'
+                    for event, time, customer, detail in batch
+                )
+            )
+            self.written += len(batch)
+        self._file.flush()
+
+    def close(self):
+        """
+        Writes everything still buffered and waits for the writer thread
+        """
+        if self._file.closed:
+            return
+        self._hand_off()
+        self._batches.put(None)
+        self._thread.join()
+        self._file.close()
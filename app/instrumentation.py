@@ -0,0 +1,123 @@
+import cProfile
+import time
+
+from metrics import Stat
+
+
+class TimedLogger:
+    """
+    Stands in for a logger and counts the time spent in its logging calls as
+    the "logging" phase. Everything else is passed through.
+    """
+
+    def __init__(self, logger, instruments: "Instruments") -> None:
+        self.logger = logger
+        for name in ("debug", "info", "warning", "error", "log"):
+            setattr(self, name, instruments.timed("logging", getattr(logger, name)))
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+class Instruments:
+    """
+    Opt-in timing of the shop loop. `timed` wraps a callable so every call
+    adds its perf_counter_ns duration to a phase; Simulation wraps its own
+    methods and the engine handlers only when instrumented, so a shop
+    without instruments runs the plain code. Gauges are sampled once per
+    loop pass into streaming Stats.
+
+    With `profile` a cProfile of the run is dumped to that path (pstats
+    format), limited to `profile_window`, a (start, end) pair of simulated
+    times where either end may be None.
+    """
+
+    PHASES = (
+        "intake",
+        "apply",
+        "dispatch",
+        "drinks",
+        "release",
+        "logging",
+        "snapshot",
+        "sleep",
+    )
+    GAUGES = ("queue_length", "busy_baristas", "drink_backlog", "pending_events")
+
+    def __init__(self, profile=None, profile_window=None) -> None:
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.nanoseconds = dict.fromkeys(self.PHASES, 0)
+        self.gauges = {name: Stat() for name in self.GAUGES}
+        self.current = dict.fromkeys(self.GAUGES, 0)
+        self.profile = profile
+        self.profile_window = profile_window or (None, None)
+        self.profiler = None
+        self.profiled = False
+
+    def timed(self, phase, function):
+        calls = self.calls
+        nanoseconds = self.nanoseconds
+        clock = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            started = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                calls[phase] += 1
+                nanoseconds[phase] += clock() - started
+
+        return timed
+
+    def timed_iter(self, phase, iterable):
+        iterator = iter(iterable)
+        step = self.timed(phase, next)
+        while True:
+            try:
+                item = step(iterator)
+            except StopIteration:
+                return
+            yield item
+
+    def sample(self, **gauges):
+        for name, value in gauges.items():
+            self.current[name] = value
+            self.gauges[name].record(value)
+
+    def profile_at(self, now):
+        """
+        Starts or stops the profiler as simulated time `now` enters or
+        leaves the profile window
+        """
+        if self.profile is None or self.profiled:
+            return
+        start, end = self.profile_window
+        if self.profiler is None:
+            if (start is None or now >= start) and (end is None or now < end):
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        elif end is not None and now >= end:
+            self.dump_profile()
+
+    def dump_profile(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile)
+            self.profiler = None
+            self.profiled = True
+
+    def snapshot(self) -> dict:
+        phases = {}
+        for phase in self.PHASES:
+            calls = self.calls[phase]
+            nanoseconds = self.nanoseconds[phase]
+            phases[phase] = {
+                "calls": calls,
+                "seconds": nanoseconds / 1e9,
+                "mean_us": nanoseconds / calls / 1e3 if calls else None,
+            }
+        gauges = {
+            name: {"current": self.current[name], **stat.snapshot()}
+            for name, stat in self.gauges.items()
+        }
+        return {"phases": phases, "gauges": gauges}
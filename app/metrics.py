@@ -0,0 +1,194 @@
+import math
+from datetime import datetime
+
+
+class Histogram:
+    """
+    Log-bucketed histogram (HDR style). Bucket i > 0 holds values up to
+    lowest * (1 + precision) ** (i - 1), so quantiles are within `precision`
+    of the true value. Bucket 0 holds everything below `lowest`. Memory is
+    fixed by the configuration and histograms with the same one merge by
+    adding counts.
+    """
+
+    def __init__(self, lowest=0.01, highest=1e7, precision=0.01):
+        self.lowest = lowest
+        self.highest = highest
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self.counts = [0] * (self._bucket(highest) + 1)
+        self.count = 0
+
+    def _bucket(self, value):
+        if value < self.lowest:
+            return 0
+        return math.ceil(math.log(value / self.lowest) / self._log_base) + 1
+
+    def record(self, value):
+        index = self._bucket(value)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        if (other.lowest, other.highest, other.precision) != (
+            self.lowest,
+            self.highest,
+            self.precision,
+        ):
+            raise ValueError("Histograms with different buckets cannot be merged")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Upper edge of the bucket holding the q-th quantile, None when empty
+        """
+        if self.count == 0:
+            return None
+        target = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                break
+        if index == 0:
+            return 0.0
+        return self.lowest * (1 + self.precision) ** (index - 1)
+
+
+class Stat:
+    """
+    Streaming count, mean, min, max and quantiles of one measure
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.histogram = Histogram()
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.histogram.record(value)
+
+    def merge(self, other: "Stat"):
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.histogram.merge(other.histogram)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        value = self.histogram.quantile(q)
+        return None if value is None else min(value, self.maximum)
+
+    def snapshot(self, quantiles=(0.5, 0.95, 0.99)) -> dict:
+        summary = {
+            "count": self.count,
+            "mean": self.mean,
+            "min": self.minimum if self.count else None,
+            "max": self.maximum if self.count else None,
+        }
+        for q in quantiles:
+            summary[f"p{round(q * 100)}"] = self.quantile(q)
+        return summary
+
+
+class ShopMetrics:
+    """
+    Aggregates fed by Rushhour as customers move through the shop. Durations
+    are recorded in seconds, overall and broken down by character, barista
+    skill and drink, with memory independent of the number of customers.
+    Instances merge, so runs in separate processes can be combined.
+    """
+
+    MEASURES = ("queue_time", "ordering_time", "prep_time", "total_time")
+    EVENTS = ("arrival", "counter", "order", "served")
+
+    def __init__(self):
+        self.time: datetime = None
+        self.events = dict.fromkeys(self.EVENTS, 0)
+        self.stats = {measure: {} for measure in self.MEASURES}
+
+    def _record(self, measure, seconds, *keys):
+        stats = self.stats[measure]
+        for key in (None,) + keys:
+            stat = stats.get(key)
+            if stat is None:
+                stat = stats[key] = Stat()
+            stat.record(seconds)
+
+    def _event(self, event, time):
+        self.events[event] += 1
+        self.time = time
+
+    def record_arrival(self, customer, time):
+        self._event("arrival", time)
+
+    def record_counter(self, customer, barista, time):
+        self._event("counter", time)
+        self._record(
+            "queue_time",
+            (time - customer.arrival_time).total_seconds(),
+            ("character", customer.character.name),
+            ("skill", barista.level.name),
+        )
+
+    def record_order(self, customer, barista, time):
+        self._event("order", time)
+        self._record(
+            "ordering_time",
+            (time - customer.order_start_time).total_seconds(),
+            ("character", customer.character.name),
+            ("skill", barista.level.name),
+            ("drink", customer.order.name),
+        )
+
+    def record_served(self, customer, time):
+        self._event("served", time)
+        keys = [("character", customer.character.name), ("drink", customer.order.name)]
+        if customer.barista is not None:
+            keys.append(("skill", customer.barista.level.name))
+        self._record("prep_time", (time - customer.order_time).total_seconds(), *keys)
+        self._record("total_time", (time - customer.arrival_time).total_seconds(), *keys)
+
+    def merge(self, other: "ShopMetrics"):
+        for event, n in other.events.items():
+            self.events[event] += n
+        for measure, stats in other.stats.items():
+            for key, stat in stats.items():
+                if key not in self.stats[measure]:
+                    self.stats[measure][key] = Stat()
+                self.stats[measure][key].merge(stat)
+        if other.time is not None and (self.time is None or other.time > self.time):
+            self.time = other.time
+
+    def snapshot(self, quantiles=(0.5, 0.95, 0.99)) -> dict:
+        """
+        Plain dict of every aggregate as of the last recorded event
+        """
+        snapshot = {
+            "time": self.time,
+            "events": dict(self.events),
+            "in_line": self.events["arrival"] - self.events["counter"],
+            "waiting_for_drink": self.events["order"] - self.events["served"],
+        }
+        for measure, stats in self.stats.items():
+            breakdown = {"all": stats[None].snapshot(quantiles) if None in stats else None}
+            for key, stat in stats.items():
+                if key is not None:
+                    breakdown.setdefault(key[0], {})[key[1]] = stat.snapshot(quantiles)
+            snapshot[measure] = breakdown
+        return snapshot
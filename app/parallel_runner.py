@@ -0,0 +1,96 @@
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from BE_Coffee_Shop import replicate
+
+
+def summarize(replications: dict, quantiles=(0.5, 0.95, 0.99)) -> dict:
+    """
+    Reduces the arrays returned by `replicate` to a few numbers per measure
+    """
+    summary = {}
+    for key in ("queue_time", "ordering_time", "prep_time"):
+        values = replications[key]
+        summary[key] = {"mean": float(values.mean()), "max": float(values.max())}
+        for q, value in zip(quantiles, np.quantile(values, quantiles)):
+            summary[key][f"p{round(q * 100)}"] = float(value)
+    summary["customers"] = int(replications["queue_time"].size)
+    return summary
+
+
+class Scenario:
+    """
+    One point of a parameter sweep. `seed` alone decides the random stream of
+    the scenario, so results do not depend on which worker runs it.
+    """
+
+    def __init__(self, menu_path, baristas, arrivals, seed=0, replications=1000):
+        self.menu_path = menu_path
+        self.baristas = list(baristas)
+        self.arrivals = list(arrivals)
+        self.seed = seed
+        self.replications = replications
+
+    def __repr__(self) -> str:
+        skills = ", ".join(b.name for b in self.baristas)
+        return f"Scenario(menu={self.menu_path}, baristas=[{skills}], customers={len(self.arrivals)}, seed={self.seed})"
+
+    def run(self) -> dict:
+        return summarize(
+            replicate(
+                self.menu_path,
+                self.replications,
+                self.arrivals,
+                self.baristas,
+                np.random.SeedSequence(self.seed),
+            )
+        )
+
+
+def _run_scenario(scenario: Scenario) -> dict:
+    return scenario.run()
+
+
+class ParallelRunner:
+    """
+    Runs scenarios across a process pool and yields (scenario, summary) pairs
+    as they finish. Workers only send summaries back and at most
+    `2 * max_workers` scenarios are in flight, so memory in the parent stays flat.
+    """
+
+    def __init__(self, max_workers=None, mp_context=None):
+        """
+        Workers start from a fork server where available, so they never
+        inherit the logging threads of the parent
+        """
+        self.max_workers = max_workers or os.cpu_count()
+        if mp_context is None and "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+        self.mp_context = mp_context
+
+    @staticmethod
+    def grid(menu_paths, barista_mixes, arrival_mixes, seeds, replications=1000):
+        for menu_path, baristas, arrivals, seed in itertools.product(
+            menu_paths, barista_mixes, arrival_mixes, seeds
+        ):
+            yield Scenario(menu_path, baristas, arrivals, seed, replications)
+
+    def run(self, scenarios):
+        scenarios = iter(scenarios)
+        with ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=self.mp_context
+        ) as executor:
+            pending = {}
+            for scenario in itertools.islice(scenarios, 2 * self.max_workers):
+                pending[executor.submit(_run_scenario, scenario)] = scenario
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    scenario = pending.pop(future)
+                    for queued in itertools.islice(scenarios, 1):
+                        pending[executor.submit(_run_scenario, queued)] = queued
+                    yield scenario, future.result()
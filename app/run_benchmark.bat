@@ -0,0 +1,12 @@
+@echo off
+
+if "%1" == "quick" goto :quick
+
+:full
+echo benchmarking ...
+python -m Benchmark.benchmark --output benchmark.json
+goto :eof
+
+:quick
+echo benchmarking (quick) ...
+python -m Benchmark.benchmark --quick --output benchmark.json
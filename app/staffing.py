@@ -0,0 +1,146 @@
+import itertools
+
+import numpy as np
+
+from BE_Coffee_Shop import Skill, replicate
+
+
+class StaffingOptimizer:
+    """
+    Finds the cheapest mix of baristas whose rush hour meets a wait-time
+    target, with `replicate` runs of the `arrivals` workload.
+
+    A mix is a tuple of head counts in Skill order and costs the sum of
+    `costs` per barista. A mix meets `target` minutes when the mean over
+    replications of the `quantile` of `measure` ("queue_time" or
+    "total_time", arrival to drink) is at most the target. Each mix is
+    judged by successive halving: `min_replications` first, doubling up to
+    `max_replications` only while the confidence interval (`z` standard
+    errors) still straddles the target.
+
+    Baristas only differ in prep time here, so the line a mix leaves does
+    not depend on skills: the smallest head count is found by bisection
+    with queue times, then mixes of at least that many baristas are judged
+    from the cheapest up. Per-replication results are cached per mix and
+    replications already run are never rerun, so repeated queries (another
+    target, say) mostly read the cache.
+    """
+
+    COSTS = {Skill.Amature: 1.0, Skill.midlevel: 1.5, Skill.expert: 2.0}
+    MEASURES = ("queue_time", "total_time")
+
+    def __init__(
+        self,
+        menu_path,
+        arrivals,
+        costs=None,
+        measure="queue_time",
+        quantile=0.95,
+        seed=0,
+        min_replications=32,
+        max_replications=512,
+        max_baristas=10,
+        z=1.96,
+    ) -> None:
+        if measure not in self.MEASURES:
+            raise ValueError(f"measure must be one of {self.MEASURES}")
+        self.menu_path = menu_path
+        self.arrivals = list(arrivals)
+        self.costs = costs if costs is not None else self.COSTS
+        self.measure = measure
+        self.quantile = quantile
+        self.seed = seed
+        self.min_replications = min_replications
+        self.max_replications = max_replications
+        self.max_baristas = max_baristas
+        self.z = z
+        self.cache = {}
+
+    def cost(self, mix) -> float:
+        return sum(n * self.costs[level] for n, level in zip(mix, Skill))
+
+    def evaluate(self, mix, replications) -> dict:
+        """
+        Per-replication quantiles of every measure for the first
+        `replications` replications of `mix`, running only the missing ones
+        """
+        done = self.cache.get(mix)
+        have = 0 if done is None else len(done["queue_time"])
+        if have < replications:
+            baristas = [level for n, level in zip(mix, Skill) for _ in range(n)]
+            result = replicate(
+                self.menu_path,
+                replications - have,
+                self.arrivals,
+                baristas,
+                self.seed,
+                first=have,
+            )
+            total = result["queue_time"] + result["ordering_time"] + result["prep_time"]
+            fresh = {
+                "queue_time": np.quantile(result["queue_time"], self.quantile, axis=1),
+                "total_time": np.quantile(total, self.quantile, axis=1),
+            }
+            if done is not None:
+                fresh = {k: np.concatenate([done[k], v]) for k, v in fresh.items()}
+            self.cache[mix] = done = fresh
+        return {k: v[:replications] for k, v in done.items()}
+
+    def meets(self, mix, target, measure=None):
+        """
+        Returns (meets, mean quantile, replications used) for `mix`
+        """
+        measure = measure or self.measure
+        replications = self.min_replications
+        while True:
+            values = self.evaluate(mix, replications)[measure]
+            mean = float(values.mean())
+            half = self.z * float(values.std(ddof=1)) / np.sqrt(replications)
+            if mean - half > target:
+                return False, mean, replications
+            if mean + half <= target or replications >= self.max_replications:
+                return mean <= target, mean, replications
+            replications = min(2 * replications, self.max_replications)
+
+    def _head_count(self, target) -> int:
+        cheapest = min(Skill, key=lambda level: self.costs[level])
+
+        def crew(n):
+            return tuple(n if level is cheapest else 0 for level in Skill)
+
+        if not self.meets(crew(self.max_baristas), target, "queue_time")[0]:
+            return None
+        low, high = 1, self.max_baristas
+        while low < high:
+            middle = (low + high) // 2
+            if self.meets(crew(middle), target, "queue_time")[0]:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def optimize(self, target) -> dict:
+        """
+        The cheapest mix meeting `target` minutes, or None when no mix of up
+        to `max_baristas` does
+        """
+        fewest = self._head_count(target)
+        if fewest is None:
+            return None
+        mixes = [
+            mix
+            for mix in itertools.product(range(self.max_baristas + 1), repeat=len(Skill))
+            if fewest <= sum(mix) <= self.max_baristas
+        ]
+        mixes.sort(key=lambda mix: (self.cost(mix), sum(mix), mix))
+        for judged, mix in enumerate(mixes, start=1):
+            meets, value, replications = self.meets(mix, target)
+            if meets:
+                return {
+                    "baristas": {level.name: n for n, level in zip(mix, Skill)},
+                    "cost": self.cost(mix),
+                    self.measure: value,
+                    "replications": replications,
+                    "mixes_judged": judged,
+                }
+        return None
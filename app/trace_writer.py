@@ -0,0 +1,141 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+TRACE_DTYPE = np.dtype(
+    [
+        ("customer", "<i8"),
+        ("arrival_time", "<i8"),
+        ("order_start_time", "<i8"),
+        ("order_time", "<i8"),
+        ("served_time", "<i8"),
+        ("drink", "<i2"),
+        ("character", "<i1"),
+        ("skill", "<i1"),
+        ("barista", "<i4"),
+    ]
+)
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def epoch_ms(time: datetime) -> int:
+    return (time - EPOCH) // MILLISECOND
+
+
+class TraceWriter:
+    """
+    Writes one fixed-width row per served customer into `directory` as
+    trace_00000.npy, trace_00001.npy, ... of at most `chunk_size` rows each.
+    Times are milliseconds since 1970-01-01 of the simulated clock, drinks
+    are codes into the `drinks` list of trace.json, characters are their
+    1-based position in Character, skill the Skill value and barista the hire
+    order (-1 when unknown).
+    """
+
+    def __init__(self, directory, chunk_size=1_000_000):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.chunk = np.empty(chunk_size, dtype=TRACE_DTYPE)
+        self.rows = 0
+        self.chunks = 0
+        self.drinks = {}
+        self.characters = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, customer, served_time: datetime):
+        drink = self.drinks.get(customer.order.name)
+        if drink is None:
+            drink = self.drinks[customer.order.name] = len(self.drinks)
+        character = self.characters.get(customer.character)
+        if character is None:
+            character = list(type(customer.character)).index(customer.character) + 1
+            self.characters[customer.character] = character
+        barista = customer.barista
+        self.chunk[self.rows] = (
+            customer.position_in_row,
+            epoch_ms(customer.arrival_time),
+            epoch_ms(customer.order_start_time),
+            epoch_ms(customer.order_time),
+            epoch_ms(served_time),
+            drink,
+            character,
+            barista.level.value if barista is not None else 0,
+            barista.hire_order if barista is not None else -1,
+        )
+        self.rows += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the rows recorded since the last flush as a new chunk and
+        refreshes trace.json, so the trace on disk is always loadable
+        """
+        if self.rows:
+            np.save(
+                os.path.join(self.directory, f"trace_{self.chunks:05d}.npy"),
+                self.chunk[: self.rows],
+            )
+            self.chunks += 1
+            self.rows = 0
+        characters = sorted(self.characters.items(), key=lambda item: item[1])
+        with open(os.path.join(self.directory, "trace.json"), "w") as file:
+            json.dump(
+                {
+                    "chunks": self.chunks,
+                    "time_unit": "ms",
+                    "epoch": EPOCH.isoformat(),
+                    "columns": TRACE_DTYPE.names,
+                    "drinks": sorted(self.drinks, key=self.drinks.get),
+                    "characters": {code: c.name for c, code in characters},
+                },
+                file,
+            )
+
+    def checkpoint(self) -> dict:
+        """
+        Flushes and returns what a writer continuing this trace after a
+        resume needs, see `restore`
+        """
+        self.flush()
+        return {
+            "chunks": self.chunks,
+            "drinks": dict(self.drinks),
+            "characters": dict(self.characters),
+        }
+
+    def restore(self, checkpoint: dict):
+        """
+        Carries on from a `checkpoint`: the next chunk follows its last one
+        and drinks keep their codes
+        """
+        self.rows = 0
+        self.chunks = checkpoint["chunks"]
+        self.drinks = dict(checkpoint["drinks"])
+        self.characters = dict(checkpoint["characters"])
+
+    def close(self):
+        self.flush()
+
+
+def load_trace(directory, mmap_mode="r"):
+    """
+    Returns the trace metadata and its chunks, memory mapped (no copy) by default
+    """
+    with open(os.path.join(directory, "trace.json")) as file:
+        meta = json.load(file)
+    chunks = [
+        np.load(os.path.join(directory, f"trace_{i:05d}.npy"), mmap_mode=mmap_mode)
+        for i in range(meta["chunks"])
+    ]
+    return meta, chunks